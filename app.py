@@ -3,14 +3,25 @@ import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import os
-import re
 import bcrypt
 import smtplib
 from email.mime.text import MIMEText
 import random
+import uuid
 import string
 import time
+import json
+import queue
+import atexit
+import threading
+import io
+import math
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from collections import deque
 from datetime import datetime, timezone, timedelta
+from perf_metrics import METRICS
+from sheets_gateway import SheetsGateway, SheetsBusyError, is_retryable
+from catalog_engine import CatalogStore, SheetsSource, search_positions, row_key, parse_bom_text, normalize_bom_frame
 
 # === 1. 頁面設定 ===
 st.set_page_config(
@@ -116,48 +127,181 @@ div[data-testid="stVerticalBlock"] > div[data-testid="stVerticalBlockBorderWrapp
 # ==========================================
 if "email" in st.secrets:
     SMTP_EMAIL = st.secrets["email"]["smtp_email"]
-    SMTP_PASSWORD = st.secrets["email"]["smtp_password"]
+    # 登入帳號預設為寄件信箱；不需登入的本機 relay 設 smtp_user = "" 且可不設密碼
+    SMTP_USER = st.secrets["email"].get("smtp_user", SMTP_EMAIL)
+    SMTP_PASSWORD = st.secrets["email"].get("smtp_password", "")
+    # 測試時可指向本機 SMTP (例如 smtp_host = "localhost", smtp_port = 1025, smtp_tls = false, smtp_user = "")
+    SMTP_HOST = st.secrets["email"].get("smtp_host", "smtp.gmail.com")
+    SMTP_PORT = int(st.secrets["email"].get("smtp_port", 587))
+    SMTP_TLS = bool(st.secrets["email"].get("smtp_tls", True))
 else:
     SMTP_EMAIL = ""
+    SMTP_USER = ""
     SMTP_PASSWORD = ""
+    SMTP_HOST, SMTP_PORT, SMTP_TLS = "smtp.gmail.com", 587, True
+
+# bcrypt 成本 (secrets: bcrypt_rounds)；調整後舊雜湊會在使用者下次登入時自動升級
+BCRYPT_ROUNDS = int(st.secrets.get("bcrypt_rounds", 12))
+
+# 同一 IP 在計算區間內失敗超過此次數後，每次登入都會延遲 (secrets: login_ip_max_failures)；
+# 辦公室共用 NAT 時大家同一個 IP，所以只減速不鎖定
+LOGIN_IP_MAX_FAILURES = int(st.secrets.get("login_ip_max_failures", 100))
+
+# 可看效能監控面板的帳號 (secrets: admin_emails = ["a@x.com", ...])
+ADMIN_EMAILS = {str(e).strip().lower() for e in st.secrets.get("admin_emails", [])}
 
 GOOGLE_SHEET_NAME = '經銷牌價表_資料庫'
+LOG_SPOOL_FILE = 'log_spool.jsonl'  # Sheets 寫入失敗時暫存的紀錄
+LOG_BATCH_SIZE = 20                 # 累積幾筆就寫入一次
+LOG_FLUSH_INTERVAL = 5              # 最多等幾秒就寫入一次
+USERS_CACHE_TTL = 60                # 帳號表快取秒數
+RESULT_PAGE_SIZE = 20               # 搜尋結果每頁卡片數
+BCRYPT_WORKERS = 2                  # 同時計算 bcrypt 的執行緒數
+BCRYPT_MAX_PENDING = 16             # 計算中 + 排隊中的上限，超過就回覆系統忙碌
+BCRYPT_TIMEOUT = 10                 # 等待 bcrypt 結果的最長秒數
+LOGIN_MAX_FAILURES = 3              # 同一 Email 在鎖定時間內可失敗的次數
+LOGIN_IP_DELAY = 1                  # IP 超過門檻後，每多失敗一次增加的延遲秒數
+LOGIN_IP_MAX_DELAY = 10             # IP 延遲的上限 (秒)
+LOGIN_LOCK_WINDOW = 900             # 失敗次數的計算區間 (秒)
+LOGIN_MAX_TRACKED = 50000           # 最多記錄幾個 Email/IP，超過時丟掉最久沒失敗的
+MAIL_OUTBOX_FILE = 'mail_outbox.jsonl'  # 待寄/寄送失敗的信件 (含新密碼，權限 0600，寄出或管理員刪除後移除)
+MAIL_BATCH_SIZE = 20                # 每次連線最多連續寄出幾封
+MAIL_MAX_ATTEMPTS = 6               # 寄送失敗的重試上限
+MAIL_RETRY_DELAY = 30               # 第一次重試的等待秒數，之後每次加倍
+MAIL_IDLE_TIMEOUT = 120             # SMTP 連線閒置多久後主動關閉
 
 # === Session State 初始化 ===
 if 'logged_in' not in st.session_state: st.session_state.logged_in = False
 if 'user_email' not in st.session_state: st.session_state.user_email = ""
 if 'real_name' not in st.session_state: st.session_state.real_name = ""
-if 'login_attempts' not in st.session_state: st.session_state.login_attempts = 0
 
 if 'calc_discount' not in st.session_state: st.session_state.calc_discount = 100.00
 if 'calc_price' not in st.session_state: st.session_state.calc_price = 0
 if 'current_base_price' not in st.session_state: st.session_state.current_base_price = 0
 
 # === 連線與工具函式 ===
+# 整個 process 共用一組配額：所有 session 與背景執行緒的 Sheets 呼叫一起排隊
+@st.cache_resource
+def get_sheets_gateway():
+    quota = dict(st.secrets.get("sheets_quota", {}))
+    return SheetsGateway(**{k: quota[k] for k in ('read_per_minute', 'write_per_minute', 'burst', 'max_wait') if k in quota})
+
+def sheets_call(name, fn, *args, **kwargs):
+    """所有 gspread 呼叫都經過這裡：依讀/寫配額排隊、相同讀取合併、429/5xx 自動重試，並記錄 'sheets.<name>' 耗時"""
+    return get_sheets_gateway().call(name, fn, *args, **kwargs)
+
+def is_busy_error(error):
+    return isinstance(error, (SheetsBusyError, PasswordBusyError, FutureTimeout)) or is_retryable(error)
+
+# 整個 process 共用一組已授權的 client (內含 HTTP 連線池，token 過期時自動換發)
+@st.cache_resource
 def get_client():
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     if "gcp_service_account" in st.secrets:
         creds_dict = dict(st.secrets["gcp_service_account"])
         creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        return gspread.authorize(creds)
+        return sheets_call("authorize", gspread.authorize, creds)
     elif os.path.exists('service_account.json'):
         creds = ServiceAccountCredentials.from_json_keyfile_name('service_account.json', scope)
-        return gspread.authorize(creds)
+        return sheets_call("authorize", gspread.authorize, creds)
     else: return None
 
+@st.cache_resource
+def get_spreadsheet():
+    client = get_client()
+    if not client: return None
+    return sheets_call("open", client.open, GOOGLE_SHEET_NAME)
+
+@st.cache_resource
+def get_worksheet(title=None):
+    """取得並快取分頁物件，title=None 代表第一頁 (一般牌價資料庫)"""
+    sh = get_spreadsheet()
+    if not sh: return None
+    if title is None: return sheets_call("sheet1", getattr, sh, "sheet1")
+    return sheets_call("worksheet", sh.worksheet, title)
+
 def get_tw_time():
     tw_tz = timezone(timedelta(hours=8))
     return datetime.now(tw_tz).strftime("%Y-%m-%d %H:%M:%S")
 
+class LogWriter:
+    """背景批次寫入 Logs 分頁：事件先進佇列，由 worker 以 append_rows 一次寫入"""
+    def __init__(self, spool_path=LOG_SPOOL_FILE, batch_size=LOG_BATCH_SIZE, interval=LOG_FLUSH_INTERVAL):
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, row):
+        self.queue.put(row)
+
+    def close(self, timeout=10):
+        """停止 worker，並把佇列中剩下的事件寫出"""
+        if self._stop.is_set(): return
+        self._stop.set()
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if batch: self._flush(batch)
+        self._flush(self._drain())
+
+    def _collect(self):
+        """等到湊滿一批或超過時間門檻，回傳這一批事件"""
+        batch = []
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size and not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try: row = self.queue.get(timeout=remaining)
+            except queue.Empty: break
+            if row is not None: batch.append(row)
+        return batch
+
+    def _drain(self):
+        batch = []
+        while True:
+            try: row = self.queue.get_nowait()
+            except queue.Empty: return batch
+            if row is not None: batch.append(row)
+
+    def _flush(self, rows):
+        # 先補送上次失敗暫存在本機的紀錄
+        rows = self._read_spool() + rows
+        if not rows: return
+        try:
+            ws = get_worksheet("Logs")
+            if not ws: return
+            sheets_call("append_rows", ws.append_rows, rows)
+            if os.path.exists(self.spool_path): os.remove(self.spool_path)
+        except Exception:
+            self._write_spool(rows)
+
+    def _read_spool(self):
+        if not os.path.exists(self.spool_path): return []
+        try:
+            with open(self.spool_path, encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except Exception: return []
+
+    def _write_spool(self, rows):
+        try:
+            with open(self.spool_path, 'w', encoding='utf-8') as f:
+                for row in rows: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        except Exception: pass
+
+@st.cache_resource
+def get_log_writer():
+    return LogWriter()
+
 def write_log(action, user_email, note=""):
-    client = get_client()
-    if not client: return
-    try:
-        sh = client.open(GOOGLE_SHEET_NAME)
-        try: ws = sh.worksheet("Logs")
-        except: return 
-        ws.append_row([get_tw_time(), user_email, action, note])
-    except: pass
+    get_log_writer().put([get_tw_time(), user_email, action, note])
 
 def get_greeting():
     tw_tz = timezone(timedelta(hours=8))
@@ -167,105 +311,364 @@ def get_greeting():
     elif 18 <= current_hour < 23: return "晚安 🌙"
     else: return "夜深了，不要太累了 ☕"
 
-def check_password(plain_text, hashed_text):
+# === 密碼驗證 ===
+class PasswordBusyError(Exception):
+    """bcrypt 排隊已滿"""
+
+class PasswordWorker:
+    """bcrypt 專用的固定大小執行緒池：同時計算數有上限，登入尖峰時排隊或回覆忙碌，不會吃滿 CPU"""
+    def __init__(self, workers=BCRYPT_WORKERS, max_pending=BCRYPT_MAX_PENDING, timeout=BCRYPT_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.timeout = timeout
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(timeout=self.timeout): raise PasswordBusyError()
+        try: future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        # 呼叫端逾時放棄時，計算仍會做完，名額在完成時才歸還
+        future.add_done_callback(lambda f: self.slots.release())
+        return future.result(timeout=self.timeout)
+
+@st.cache_resource
+def get_password_worker():
+    return PasswordWorker()
+
+class LoginThrottle:
+    """process 共用的登入失敗計數，重新整理頁面也不會歸零：Email 失敗過多時鎖定，IP 失敗過多時只延遲"""
+    def __init__(self, max_failures=LOGIN_MAX_FAILURES, ip_max_failures=LOGIN_IP_MAX_FAILURES, window=LOGIN_LOCK_WINDOW, max_tracked=LOGIN_MAX_TRACKED,
+                 ip_delay=LOGIN_IP_DELAY, ip_max_delay=LOGIN_IP_MAX_DELAY):
+        self.limits = {'email': max_failures, 'ip': ip_max_failures}
+        self.window = window
+        self.max_tracked = max_tracked
+        self.ip_delay, self.ip_max_delay = ip_delay, ip_max_delay
+        self.failures = {}  # (種類, 值) -> deque[失敗時間]，依最後一次失敗時間排序 (最舊的在前)
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        attempts = self.failures.get(key)
+        if attempts is None: return None
+        while attempts and attempts[0] <= now - self.window: attempts.popleft()
+        if not attempts: del self.failures[key]
+        return attempts or None
+
+    def _keys(self, email, ip):
+        keys = [('email', normalize_email(email))]
+        if ip: keys.append(('ip', ip))
+        return keys
+
+    def retry_after(self, email):
+        """這個 Email 仍在鎖定中時回傳需等待的秒數，否則回傳 0"""
+        now = time.time()
+        with self._lock:
+            attempts = self._recent(('email', normalize_email(email)), now)
+            if attempts and len(attempts) >= self.limits['email']: return attempts[0] + self.window - now
+            return 0
+
+    def delay(self, ip):
+        """IP 失敗次數超過門檻時，這次登入前要延遲的秒數 (不鎖定，同一 IP 的其他帳號仍可登入)"""
+        if not ip: return 0
+        with self._lock:
+            excess = len(self._recent(('ip', ip), time.time()) or ()) - self.limits['ip']
+        return min(self.ip_delay * (excess + 1), self.ip_max_delay) if excess >= 0 else 0
+
+    def record_failure(self, email, ip=None):
+        """記錄一次失敗，回傳這個 Email 剩餘可嘗試次數"""
+        now = time.time()
+        with self._lock:
+            for key in self._keys(email, ip):
+                attempts = self.failures.pop(key, None) or deque()
+                attempts.append(now)
+                self.failures[key] = attempts  # 重新插入，移到最後
+            self._prune(now)
+            attempts = self._recent(('email', normalize_email(email)), now)
+            return max(self.limits['email'] - len(attempts or ()), 0)
+
+    def _prune(self, now):
+        """從最久沒失敗的開始丟掉已過期或超過上限的 key，隨機 Email 大量嘗試時 dict 不會無限成長"""
+        while self.failures:
+            key, attempts = next(iter(self.failures.items()))
+            if attempts[-1] > now - self.window and len(self.failures) <= self.max_tracked: break
+            del self.failures[key]
+
+    def reset(self, email):
+        with self._lock: self.failures.pop(('email', normalize_email(email)), None)
+
+@st.cache_resource
+def get_login_throttle():
+    return LoginThrottle()
+
+def client_ip():
+    try: return st.context.ip_address
+    except Exception: return None
+
+def verify_hash(plain_text, hashed_text):
     try: return bcrypt.checkpw(plain_text.encode('utf-8'), hashed_text.encode('utf-8'))
     except: return False
 
+def hash_rounds(hashed_text):
+    """'$2b$12$...' -> 12；格式不符時回傳 None"""
+    try: return int(str(hashed_text).split('$')[2])
+    except: return None
+
+def check_password(plain_text, hashed_text):
+    with METRICS.timed("bcrypt.check"): return get_password_worker().run(verify_hash, plain_text, hashed_text)
+
 def hash_password(plain_text):
-    return bcrypt.hashpw(plain_text.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    with METRICS.timed("bcrypt.hash"):
+        hashed = get_password_worker().run(bcrypt.hashpw, plain_text.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
+    return hashed.decode('utf-8')
 
 def generate_random_password(length=8):
     chars = string.ascii_letters + string.digits
     return ''.join(random.choice(chars) for i in range(length))
 
-def send_reset_email(to_email, new_password):
-    if not SMTP_EMAIL or not SMTP_PASSWORD: return False, "系統未設定寄信信箱。"
+class MailOutbox:
+    """背景寄信：信件先寫入本機 outbox 檔，由 worker 沿用同一條已登入的 SMTP 連線寄出，失敗時指數退避重試。
+    重試用盡的信件標為 failed 留在 outbox，由管理員在側邊欄重寄或刪除"""
+    def __init__(self, path=MAIL_OUTBOX_FILE, host=SMTP_HOST, port=SMTP_PORT, tls=SMTP_TLS, sender=SMTP_EMAIL, user=SMTP_USER, password=SMTP_PASSWORD):
+        self.path = path
+        self.host, self.port, self.tls = host, port, tls
+        self.sender, self.user, self.password = sender, user, password
+        self.pending = self._load()  # 上次未寄出的信件，重新啟動後繼續寄
+        self._conn = None
+        self._last_used = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mail-sender", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, to_email, subject, body):
+        item = {'id': uuid.uuid4().hex, 'to': to_email, 'subject': subject, 'body': body, 'attempts': 0, 'next_at': 0,
+                'status': 'pending', 'queued_at': get_tw_time(), 'error': ''}
+        with self._lock:
+            self.pending.append(item)
+            self._save()
+        self._wake.set()
+
+    def items(self):
+        """目前 outbox 內的信件狀態 (不含內文)"""
+        with self._lock:
+            return [{k: item.get(k, '') for k in ('id', 'to', 'status', 'attempts', 'queued_at', 'error')} for item in self.pending]
+
+    def retry(self, item_id):
+        with self._lock:
+            for item in self.pending:
+                if item['id'] == item_id: item.update(status='pending', attempts=0, next_at=0, error='')
+            self._save()
+        self._wake.set()
+
+    def discard(self, item_id):
+        with self._lock:
+            self.pending = [item for item in self.pending if item['id'] != item_id]
+            self._save()
+
+    def close(self, timeout=10):
+        if self._stop.is_set(): return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self._next_wait())
+            self._wake.clear()
+            self._send_due()
+            if self._conn and time.monotonic() - self._last_used > MAIL_IDLE_TIMEOUT: self._disconnect()
+        self._send_due()
+        self._disconnect()
+
+    def _next_wait(self):
+        with self._lock: next_at = min((item['next_at'] for item in self.pending if item.get('status') != 'failed'), default=None)
+        if next_at is None: return MAIL_IDLE_TIMEOUT
+        return min(max(next_at - time.time(), 0), MAIL_IDLE_TIMEOUT)
+
+    def _send_due(self):
+        now = time.time()
+        with self._lock: due = [item for item in self.pending if item.get('status') != 'failed' and item['next_at'] <= now][:MAIL_BATCH_SIZE]
+        if not due: return
+        finished = set()
+        for item in due:
+            try:
+                self._connect().send_message(self._message(item))
+                self._last_used = time.monotonic()
+                finished.add(item['id'])
+            except Exception as e:
+                self._disconnect()
+                item['attempts'] += 1
+                item['error'] = type(e).__name__
+                # 收件者被拒絕是永久錯誤，不再重試；使用者的密碼已換掉，信件留在 outbox 等管理員處理
+                if isinstance(e, smtplib.SMTPRecipientsRefused) or item['attempts'] >= MAIL_MAX_ATTEMPTS:
+                    item['status'] = 'failed'
+                    write_log("寄信失敗", item['to'], type(e).__name__)
+                else:
+                    item['next_at'] = time.time() + MAIL_RETRY_DELAY * 2 ** (item['attempts'] - 1) * random.uniform(0.5, 1.5)
+        with self._lock:
+            self.pending = [item for item in self.pending if item['id'] not in finished]
+            self._save()
+
+    def _message(self, item):
+        msg = MIMEText(item['body']); msg['Subject'] = item['subject']; msg['From'] = self.sender; msg['To'] = item['to']
+        return msg
+
+    def _connect(self):
+        """沿用現有連線 (NOOP 確認仍有效)，斷線時才重新 EHLO/STARTTLS/登入"""
+        if self._conn is not None:
+            try:
+                if self._conn.noop()[0] == 250: return self._conn
+            except Exception: pass
+            self._disconnect()
+        conn = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            conn.ehlo()
+            if self.tls: conn.starttls(); conn.ehlo()
+            if self.user: conn.login(self.user, self.password)
+        except Exception:
+            conn.close()
+            raise
+        self._conn = conn
+        return conn
+
+    def _disconnect(self):
+        if self._conn is None: return
+        try: self._conn.quit()
+        except Exception:
+            try: self._conn.close()
+            except Exception: pass
+        self._conn = None
+
+    def _load(self):
+        if not os.path.exists(self.path): return []
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except Exception: return []
+
+    def _save(self):
+        """整份重寫後替換；檔案只有擁有者可讀寫"""
+        if not self.pending:
+            if os.path.exists(self.path): os.remove(self.path)
+            return
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for item in self.pending: f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+@st.cache_resource
+def get_mail_outbox():
+    return MailOutbox()
+
+def queue_reset_email(to_email, new_password):
     subject = "【士林電機FA】密碼重置通知"
     body = f"您好：\n您的系統密碼已重置。\n新密碼為：{new_password}\n請使用此密碼登入後，盡快修改為您習慣的密碼。"
-    msg = MIMEText(body); msg['Subject'] = subject; msg['From'] = SMTP_EMAIL; msg['To'] = to_email
+    get_mail_outbox().put(to_email, subject, body)
+
+def normalize_email(email):
+    return str(email).strip().lower()
+
+@st.cache_resource(ttl=USERS_CACHE_TTL)
+def load_user_table():
+    """Users 分頁 -> {正規化 email: {'row': 列號, 'hash': 密碼雜湊, 'name': 姓名}}"""
+    METRICS.miss("帳號表")
+    ws = get_worksheet("Users")
+    if not ws: return None
+    users = {}
+    # get_all_records 從第 2 列 (標題列之後) 開始
+    for row_no, user in enumerate(sheets_call("get_all_records", ws.get_all_records), start=2):
+        key = normalize_email(user.get('email'))
+        if key and key not in users:
+            users[key] = {'row': row_no, 'email': str(user.get('email')), 'hash': str(user.get('password')), 'name': user.get('name')}
+    return users
+
+def find_user(email):
+    METRICS.lookup("帳號表")
+    users = load_user_table()
+    if users is None: return None, False
+    return users.get(normalize_email(email)), True
+
+def locate_user_row(ws, user):
+    """快取的列號最多晚 USERS_CACHE_TTL 秒，期間有人插入/刪除/排序就會指到別人：
+    寫入前確認該列的 email 仍相符，不符時清除快取並重新 find。回傳 (列號, 該列內容)，找不到時回傳 (None, None)"""
+    values = sheets_call("row_values", ws.row_values, user['row'])
+    if values and normalize_email(values[0]) == normalize_email(user['email']): return user['row'], values
+    load_user_table.clear()
+    cell = sheets_call("find", ws.find, user['email'], in_column=1)
+    if cell is None: return None, None
+    return cell.row, sheets_call("row_values", ws.row_values, cell.row)
+
+def update_password_hash(user, new_password, expect_hash=None):
+    """寫入新雜湊，回傳是否寫入 (帳號已被刪除時為 False)。
+    expect_hash 有值時，該列目前的雜湊必須與它相同才寫入，避免用過期的快取蓋掉剛改過的密碼"""
+    ws = get_worksheet("Users")
+    new_hash = hash_password(new_password)
+    row, values = locate_user_row(ws, user)
+    if row is None: return False
+    if expect_hash is not None and (values[1] if len(values) > 1 else '') != expect_hash: return False
+    sheets_call("update_cell", ws.update_cell, row, 2, new_hash)
+    load_user_table.clear()
+    return True
+
+def login(email, password, ip=None):
+    throttle = get_login_throttle()
+    wait = throttle.retry_after(email)
+    if wait: return False, f"⚠️ 登入失敗次數過多，請 {math.ceil(wait / 60)} 分鐘後再試。"
+    delay = throttle.delay(ip)
+    if delay: time.sleep(delay)
     try:
-        with smtplib.SMTP('smtp.gmail.com', 587) as smtp:
-            smtp.ehlo(); smtp.starttls(); smtp.login(SMTP_EMAIL, SMTP_PASSWORD); smtp.send_message(msg)
-        return True, "信件發送成功"
-    except Exception as e: return False, "寄信失敗，請稍後再試。"
-
-@st.cache_data(ttl=600)
-def get_update_date():
-    client = get_client()
-    if not client: return ""
-    try:
-        sh = client.open(GOOGLE_SHEET_NAME)
-        ws = sh.worksheet("Users")
-        date_val = ws.cell(1, 4).value
-        return date_val if date_val else "未知"
-    except: return "未知"
-
-def login(email, password):
-    client = get_client()
-    if not client: return False, "連線失敗"
-    try:
-        sh = client.open(GOOGLE_SHEET_NAME)
-        ws = sh.worksheet("Users")
-        users = ws.get_all_records()
-        for user in users:
-            if str(user.get('email')).strip() == email.strip():
-                if check_password(password, str(user.get('password'))):
-                    found_name = str(user.get('name')) if user.get('name') else email
-                    write_log("登入成功", email)
-                    return True, found_name
-                else:
-                    write_log("登入失敗", email, "密碼錯誤")
-                    return False, "密碼錯誤"
-        write_log("登入失敗", email, "帳號不存在")
-        return False, "此 Email 尚未註冊"
-    except Exception as e: return False, "登入過程錯誤"
+        user, connected = find_user(email)
+        if not connected: return False, "連線失敗"
+        if not user:
+            write_log("登入失敗", email, "帳號不存在")
+            remaining = throttle.record_failure(email, ip)
+            return False, f"此 Email 尚未註冊 (剩餘: {remaining})"
+        if check_password(password, user['hash']):
+            throttle.reset(email)
+            found_name = str(user['name']) if user['name'] else email
+            write_log("登入成功", email)
+            # 成本設定變更後，趁有明文密碼時重新雜湊 (快取的雜湊已過期就跳過)
+            if hash_rounds(user['hash']) != BCRYPT_ROUNDS:
+                try: update_password_hash(user, password, expect_hash=user['hash'])
+                except Exception: pass
+            return True, found_name
+        write_log("登入失敗", email, "密碼錯誤")
+        remaining = throttle.record_failure(email, ip)
+        return False, f"密碼錯誤 (剩餘: {remaining})"
+    except Exception as e: return False, "系統忙碌中，請稍後再試" if is_busy_error(e) else "登入過程錯誤"
 
 def change_password(email, new_password):
-    client = get_client()
-    if not client: return False
     try:
-        sh = client.open(GOOGLE_SHEET_NAME)
-        ws = sh.worksheet("Users")
-        cell = ws.find(email)
-        if cell:
-            ws.update_cell(cell.row, 2, hash_password(new_password))
-            write_log("修改密碼", email, "使用者自行修改")
-            return True
-        return False
+        user, _ = find_user(email)
+        if not user or not update_password_hash(user, new_password): return False
+        write_log("修改密碼", email, "使用者自行修改")
+        return True
     except: return False
 
 def reset_password_flow(target_email):
-    client = get_client()
-    if not client: return False, "連線失敗"
     try:
-        sh = client.open(GOOGLE_SHEET_NAME)
-        ws = sh.worksheet("Users")
-        try: cell = ws.find(target_email.strip())
-        except gspread.exceptions.CellNotFound: return False, "此 Email 尚未註冊"
+        user, connected = find_user(target_email)
+        if not connected: return False, "連線失敗"
+        if not user: return False, "此 Email 尚未註冊"
+        if not SMTP_EMAIL or (SMTP_USER and not SMTP_PASSWORD): return False, "系統未設定寄信信箱。"
         new_pw = generate_random_password()
-        sent, msg = send_reset_email(target_email, new_pw)
-        if not sent: return False, msg
-        ws.update_cell(cell.row, 2, hash_password(new_pw))
+        # 先寫入新雜湊再排入寄信，信件由背景寄出，不必等 SMTP 交握
+        if not update_password_hash(user, new_pw): return False, "此 Email 尚未註冊"
+        queue_reset_email(target_email, new_pw)
         write_log("重置密碼", target_email, "忘記密碼重置")
-        return True, "重置成功！新密碼已寄送到您的信箱。"
-    except Exception as e: return False, "重置失敗"
+        return True, "重置成功！新密碼將於幾分鐘內寄送到您的信箱。"
+    except Exception as e: return False, "系統忙碌中，請稍後再試" if is_busy_error(e) else "重置失敗"
 
-@st.cache_data(ttl=600)
-def load_data():
-    client = get_client()
-    if not client: return pd.DataFrame()
-    try:
-        sh = client.open(GOOGLE_SHEET_NAME)
-        data = sh.sheet1.get_all_records()
-        return pd.DataFrame(data).astype(str)
-    except: return pd.DataFrame()
-
-def clean_currency(val):
-    if not val or pd.isna(val): return None
-    val_str = str(val)
-    clean_str = re.sub(r'[^\d.]', '', val_str)
-    try: return float(clean_str)
-    except ValueError: return None
+# === 牌價資料快照 ===
+@st.cache_resource
+def get_catalog_store():
+    return CatalogStore(SheetsSource(get_worksheet, sheets_call))
+
+def get_catalog():
+    return get_catalog_store().snapshot
 
 # ==========================================
 #  🔥 彈出式計算機
@@ -318,6 +721,185 @@ def show_calculator_dialog(spec, desc, base_price):
 # ==========================================
 #               主程式
 # ==========================================
+def render_search(catalog):
+    df = catalog.df
+    search_term = st.text_input("輸入關鍵字搜尋", "", placeholder="例如: FX5U / SDC / 馬達")
+
+    # 關鍵字或資料版本變動時回到第一頁
+    view = (search_term, catalog.loaded_at)
+    if st.session_state.get('search_view') != view:
+        st.session_state.search_view = view
+        st.session_state.search_page = 0
+
+    # 只排序到目前這一頁的頁尾，總筆數另外回傳
+    rows, result_count = search_positions(catalog, search_term, (st.session_state.search_page + 1) * RESULT_PAGE_SIZE)
+
+    if result_count and '規格' in df.columns:
+        page_count = math.ceil(result_count / RESULT_PAGE_SIZE)
+        page = min(st.session_state.search_page, page_count - 1)
+        page_rows = rows[page * RESULT_PAGE_SIZE:(page + 1) * RESULT_PAGE_SIZE]
+        st.success(f"搜尋結果：共 {result_count} 筆" + (f" (第 {page + 1} / {page_count} 頁)" if page_count > 1 else ""))
+
+        # === 手機版智慧顯示：每次只組出目前這一頁的卡片 ===
+        render_start = time.perf_counter()
+        seen = set()
+        for index, row in zip(page_rows, df.iloc[page_rows].to_dict('records')):
+            spec = str(row['規格']) if pd.notna(row['規格']) else ""
+            dist_price_val = None if row.get('需洽詢', True) else row['經銷價_數值']
+            price_display = row.get('經銷價_顯示', "請洽詢")
+
+            desc = str(row.get('說明', '')) if pd.notna(row.get('說明', '')) else ""
+            order_mark = "📦" if str(row.get('訂購品(V)', '')).strip() == 'V' else ""
+            key = row_key(row)
+            if key in seen: key = f"{key}_{index}"  # 內容完全相同的重複列
+            seen.add(key)
+
+            with st.container():
+                c_info, c_btn = st.columns([3, 1.2])
+
+                with c_info:
+                    card = f'<div class="card-spec">{spec}</div>'
+                    card += f'<div class="card-price">{price_display} <span style="font-size:0.9rem;color:#86868b;font-weight:400;">(經銷價)</span> {order_mark}</div>'
+                    if desc: card += f'<div class="card-desc">{desc}</div>'
+                    st.markdown(card, unsafe_allow_html=True)
+
+                with c_btn:
+                    st.write("")
+                    if dist_price_val is not None:
+                        if st.button("試算", key=f"btn_{key}", use_container_width=True):
+                            show_calculator_dialog(spec, desc, float(dist_price_val))
+                    else:
+                        st.button("試算", key=f"btn_{key}", disabled=True, use_container_width=True)
+
+                st.markdown("---")
+        METRICS.observe("render.cards", time.perf_counter() - render_start)
+
+        if page_count > 1:
+            c_prev, c_page, c_next = st.columns([1, 1, 1])
+            with c_prev:
+                if st.button("← 上一頁", key="page_prev", disabled=page == 0, use_container_width=True):
+                    st.session_state.search_page = page - 1
+                    st.rerun()
+            with c_page:
+                st.markdown(f"<div style='text-align:center;padding-top:8px;'>{page + 1} / {page_count}</div>", unsafe_allow_html=True)
+            with c_next:
+                if st.button("下一頁 →", key="page_next", disabled=page >= page_count - 1, use_container_width=True):
+                    st.session_state.search_page = page + 1
+                    st.rerun()
+    else:
+        if search_term: st.warning("查無資料")
+
+def render_bundles(catalog):
+    bundles = catalog.bundles
+    series_names = bundles.series_names()
+    if not series_names:
+        st.info("目前沒有整套搭配資料")
+        return
+    series = st.selectbox("選擇系列", series_names)
+    for _, bundle in bundles.bundles(series).iterrows():
+        name = bundle['組合']
+        parts = bundles.components(series, name)
+        desc = "、".join(f"{spec} ×{qty:g}" for spec, qty in zip(parts['規格'], parts['數量']))
+        complete = bool(bundle['完整報價'])
+        price_display = f"${bundle['經銷價合計']:,.0f}" if complete else "請洽詢"
+
+        with st.container():
+            c_info, c_btn = st.columns([3, 1.2])
+
+            with c_info:
+                st.markdown(f'<div class="card-spec">{name}</div>', unsafe_allow_html=True)
+                st.markdown(f'<div class="card-price">{price_display} <span style="font-size:0.9rem;color:#86868b;font-weight:400;">(經銷價合計)</span></div>', unsafe_allow_html=True)
+                note = f"牌價合計 ${bundle['牌價合計']:,.0f}・共 {bundle['品項數']} 項"
+                if not complete: note += f"・{bundle['品項數'] - bundle['已定價品項']} 項未定價"
+                st.markdown(f'<div class="card-desc">{note}</div>', unsafe_allow_html=True)
+
+            with c_btn:
+                st.write("")
+                key = f"bundle_{series}_{name}"
+                if complete:
+                    if st.button("試算", key=key, use_container_width=True):
+                        show_calculator_dialog(name, desc, float(bundle['經銷價合計']))
+                else:
+                    st.button("試算", key=key, disabled=True, use_container_width=True)
+
+            with st.expander("元件明細"):
+                detail = parts[['規格', '說明', '數量', '牌價_數值', '經銷價_數值', '經銷價小計']]
+                st.dataframe(detail.rename(columns={'牌價_數值': '牌價', '經銷價_數值': '經銷價'}), use_container_width=True, hide_index=True)
+
+            st.markdown("---")
+
+def read_bom_upload(uploaded):
+    if uploaded.name.lower().endswith('.csv'): return pd.read_csv(uploaded, dtype=str)
+    return pd.read_excel(uploaded, dtype=str)
+
+def bom_to_xlsx(result):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        result.to_excel(writer, index=False, sheet_name='報價明細')
+    return buffer.getvalue()
+
+def render_bom_quote(catalog):
+    st.caption("貼上「規格 數量」(每行一筆；從 Excel 複製時可含第三欄折數)，或上傳含規格/數量/折數欄的 Excel、CSV")
+    with st.form("bom_form"):
+        bom_text = st.text_area("BOM 清單", height=200, placeholder="FX5U-32MR/ES\t2\nSDC-020\t1\t95")
+        uploaded = st.file_uploader("或上傳檔案", type=['xlsx', 'xls', 'csv'])
+        discount = st.number_input("整批販售折數 (%)", min_value=0.0, max_value=300.0, value=100.0, step=0.5, format="%.2f")
+        submitted = st.form_submit_button("開始報價", use_container_width=True)
+    if submitted:
+        try: bom = normalize_bom_frame(read_bom_upload(uploaded)) if uploaded else parse_bom_text(bom_text)
+        except Exception: bom = None
+        if bom is None or bom.empty:
+            st.warning("請輸入或上傳 BOM 清單")
+            st.session_state.pop('bom_result', None)
+        else:
+            with METRICS.timed("bom.quote"): st.session_state.bom_result = catalog.parts.quote(bom, discount)
+
+    result = st.session_state.get('bom_result')
+    if result is None: return
+    counts = result['狀態'].value_counts()
+    total = result['小計'].sum()
+    st.success(f"共 {len(result)} 行，報價合計：${total:,.0f} (只計「符合」的 {int(counts.get('符合', 0))} 行)")
+    problems = {s: int(counts.get(s, 0)) for s in ['數量錯誤', '折數錯誤', '查無', '多筆符合', '需洽詢'] if counts.get(s, 0)}
+    if problems: st.warning("、".join(f"{s} {n} 行" for s, n in problems.items()) + "，請確認標示的項目 (未計入合計)")
+    ambiguous = result[result['狀態'] == '多筆符合']
+    if len(ambiguous):
+        st.info(f"多筆符合的 {len(ambiguous)} 行以第一筆價格估算：${(ambiguous['單價'] * ambiguous['數量']).sum():,.0f} (另計)")
+    st.dataframe(result, use_container_width=True, hide_index=True)
+    st.download_button("下載報價單 (xlsx)", bom_to_xlsx(result), file_name=f"報價單_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
+
+def render_metrics_panel():
+    with st.expander("⏱️ 效能監控"):
+        timings = METRICS.timings()
+        if timings: st.dataframe(pd.DataFrame(timings), use_container_width=True, hide_index=True)
+        caches = METRICS.cache_ratios()
+        if caches: st.dataframe(pd.DataFrame(caches), use_container_width=True, hide_index=True)
+        if not timings and not caches: st.caption("尚無資料")
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        st.download_button("匯出 Prometheus", METRICS.to_prometheus(), file_name=f"price_system_{stamp}.prom", mime="text/plain", use_container_width=True)
+        st.download_button("匯出 JSON", METRICS.to_json(), file_name=f"price_system_{stamp}.json", mime="application/json", use_container_width=True)
+
+MAIL_STATUS_LABELS = {'pending': '寄送中', 'failed': '寄送失敗'}
+
+def render_mail_panel():
+    outbox = get_mail_outbox()
+    items = outbox.items()
+    failed = sum(item['status'] == 'failed' for item in items)
+    with st.expander(f"✉️ 待寄信件 ({len(items)})" + (f" ⚠️ 失敗 {failed}" if failed else "")):
+        if not items: st.caption("沒有待寄信件")
+        for item in items:
+            st.markdown(f"**{item['to']}**  \n{MAIL_STATUS_LABELS.get(item['status'], item['status'])} · 已嘗試 {item['attempts']} 次 · {item['queued_at']}"
+                        + (f" · {item['error']}" if item['error'] else ""))
+            if item['status'] == 'failed':
+                c_retry, c_drop = st.columns(2)
+                if c_retry.button("重寄", key=f"mail_retry_{item['id']}", use_container_width=True):
+                    outbox.retry(item['id'])
+                    st.rerun()
+                if c_drop.button("刪除", key=f"mail_drop_{item['id']}", use_container_width=True):
+                    outbox.discard(item['id'])
+                    write_log("刪除待寄信件", st.session_state.user_email, item['to'])
+                    st.rerun()
+
 def main_app():
     if not st.session_state.logged_in:
         col1, col2, col3 = st.columns([1, 2, 1])
@@ -325,10 +907,6 @@ def main_app():
             st.markdown("<br><br>", unsafe_allow_html=True)
             st.header("🔒 士林電機FA 2026年經銷牌價")
             
-            if st.session_state.login_attempts >= 3:
-                st.error("⚠️ 登入失敗次數過多，請重新整理網頁後再試。")
-                return
-
             tab1, tab2 = st.tabs(["會員登入", "忘記密碼"])
             default_email = st.query_params.get("email", "")
 
@@ -339,16 +917,13 @@ def main_app():
                     submitted = st.form_submit_button("登入", use_container_width=True)
                     if submitted:
                         with st.spinner("正在驗證身分..."):
-                            success, result = login(input_email, input_pass)
+                            success, result = login(input_email, input_pass, client_ip())
                             if success:
                                 st.session_state.logged_in = True
                                 st.session_state.user_email = input_email
                                 st.session_state.real_name = result
-                                st.session_state.login_attempts = 0
                                 st.rerun()
-                            else:
-                                st.session_state.login_attempts += 1
-                                st.error(f"{result} (剩餘: {3 - st.session_state.login_attempts})")
+                            else: st.error(result)
             with tab2:
                 st.caption("系統將發送新密碼至您的 Email")
                 with st.form("reset_form"):
@@ -375,78 +950,26 @@ def main_app():
                     if change_password(st.session_state.user_email, new_pwd): st.success("已更新！")
                     else: st.error("失敗")
         
+        if normalize_email(st.session_state.user_email) in ADMIN_EMAILS:
+            render_metrics_panel()
+            render_mail_panel()
+
         if st.button("登出", use_container_width=True):
             st.session_state.logged_in = False
             st.rerun()
 
     # --- 主查詢介面 ---
     st.title("🔍 士林電機FA 2026年經銷牌價")
-    update_date = get_update_date()
+    catalog = get_catalog()
+    update_date = catalog.update_date
     if update_date: st.caption(f"📅 資料庫最後更新：{update_date}")
     st.markdown("---")
 
-    df = load_data()
-
-    if not df.empty:
-        search_term = st.text_input("輸入關鍵字搜尋", "", placeholder="例如: FX5U / SDC / 馬達")
-        
-        display_df = df.copy()
-        if search_term:
-            valid_search = [c for c in ['NO.', '規格', '說明'] if c in display_df.columns]
-            mask = display_df[valid_search].apply(lambda x: x.str.contains(search_term, case=False, na=False)).any(axis=1)
-            display_df = display_df[mask]
-
-        final_cols = ['規格', '牌價', '經銷價', '說明', '訂購品(V)']
-        final_cols = [c for c in final_cols if c in display_df.columns]
-        
-        if not display_df.empty and final_cols:
-            final_df = display_df[final_cols].copy()
-            for col in ['牌價', '經銷價']:
-                if col in final_df.columns:
-                    final_df[col] = final_df[col].apply(clean_currency)
-
-            result_count = len(final_df)
-            
-            # === 手機版智慧顯示 ===
-            if result_count > 50:
-                st.info(f"搜尋結果：共 {result_count} 筆 (請縮小範圍至 50 筆以內以使用試算功能)")
-                st.dataframe(final_df, use_container_width=True, hide_index=True)
-            else:
-                st.success(f"搜尋結果：共 {result_count} 筆")
-                
-                for index, row in final_df.iterrows():
-                    spec = str(row['規格']) if pd.notna(row['規格']) else ""
-                    dist_price_val = row['經銷價']
-                    
-                    if pd.isna(dist_price_val) or dist_price_val == "":
-                        dist_price_val = None
-                        price_display = "請洽詢"
-                    else:
-                        price_display = f"${dist_price_val:,.0f}"
-
-                    desc = str(row['說明']) if pd.notna(row['說明']) else ""
-                    order_mark = "📦" if str(row.get('訂購品(V)', '')).strip() == 'V' else ""
-
-                    with st.container():
-                        c_info, c_btn = st.columns([3, 1.2]) 
-                        
-                        with c_info:
-                            st.markdown(f'<div class="card-spec">{spec}</div>', unsafe_allow_html=True)
-                            st.markdown(f'<div class="card-price">{price_display} <span style="font-size:0.9rem;color:#86868b;font-weight:400;">(經銷價)</span> {order_mark}</div>', unsafe_allow_html=True)
-                            if desc:
-                                st.markdown(f'<div class="card-desc">{desc}</div>', unsafe_allow_html=True)
-                        
-                        with c_btn:
-                            st.write("") 
-                            if dist_price_val is not None:
-                                if st.button("試算", key=f"btn_{index}", use_container_width=True):
-                                    show_calculator_dialog(spec, desc, float(dist_price_val))
-                            else:
-                                st.button("試算", key=f"btn_{index}", disabled=True, use_container_width=True)
-                        
-                        st.markdown("---") 
-        else:
-            if search_term: st.warning("查無資料")
+    if not catalog.df.empty:
+        tab_search, tab_bundle, tab_bom = st.tabs(["🔍 單品查詢", "🧩 整套搭配", "📋 批量報價"])
+        with tab_search: render_search(catalog)
+        with tab_bundle: render_bundles(catalog)
+        with tab_bom: render_bom_quote(catalog)
     else:
         st.error("資料庫連線異常，請稍後再試。")
 
@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import openpyxl
+import pandas as pd
+import gspread
+import data_merger
+from sheets_gateway import SheetsGateway
+from catalog_snapshot import prepare_prices, compact_catalog, write_snapshot, read_snapshot
+from catalog_engine import NgramIndex, FuzzyIndex, BundleBook, PartLookup, ranked_positions, row_key, parse_bom_text
+
+# === 設定區 ===
+DEFAULT_ROWS = [1000, 10000, 100000]
+DEFAULT_REPEAT = 3
+ROWS_PER_SHEET = 5000          # 合成活頁簿每個分頁的列數
+SHEETS_PER_FILE = 4
+CARD_PAGE_SIZE = 20            # 與 app.py 的 RESULT_PAGE_SIZE 相同
+BOM_LINES = 200
+SEARCH_TERMS = ['MR', 'FX5U', 'FX5U-32MR', 'fx5u32m', 'mr-j4 100a', 'SDC', '伺服馬達', '驅動器', 'HG-KR-43', 'fx3g-60mt/es']
+
+SERIES = ['FX5U', 'FX3G', 'FX5UC', 'MR-J4', 'MR-JE', 'HG-KR', 'HG-SR', 'QJ71', 'SDC', 'A800', 'E700', 'GOT2000']
+SUFFIXES = ['MR/ES', 'MT/ES', 'MR/DS', 'A', 'B', 'MT/ESS', '-R', 'H']
+DESC_WORDS = ['伺服馬達', '驅動器', '可程式控制器', '主機', '擴充模組', '電源模組', '人機介面', '變頻器',
+              '通訊模組', '輸入', '輸出', '繼電器', '電晶體', '中慣量', '低慣量', '煞車', '編碼器']
+# 標題列的寫法變化：空白、全形括號都要靠 clean_header_name 清掉
+HEADER_VARIANTS = [
+    ['NO.', '規格', '牌價', '經銷價', '說明', '訂購品(V)'],
+    ['NO.', '規 格', '牌 價', '經銷價', '說明', '訂購品（V）'],
+    ['NO.', '規格 ', ' 牌價', '經 銷 價', '說 明', '訂購品（Ｖ）'],
+]
+# 牌價欄的幣別字串變化，'請洽詢' 會被清成 NaN
+PRICE_FORMATS = ['{:,}', '${:,}', 'NT${:,}', '{}', '$ {:,}元']
+
+# === 合成資料 ===
+def make_row(rng, no):
+    series = rng.choice(SERIES)
+    spec = f"{series}-{rng.randint(1, 999)}{rng.choice(SUFFIXES)}"
+    list_price = rng.randint(500, 200000)
+    dealer = int(list_price * rng.uniform(0.55, 0.9))
+    fmt = rng.choice(PRICE_FORMATS)
+    dealer_text = '請洽詢' if rng.random() < 0.03 else fmt.format(dealer)
+    desc = " ".join(rng.sample(DESC_WORDS, rng.randint(1, 3)))
+    return [no, spec, fmt.format(list_price), dealer_text, desc, 'V' if rng.random() < 0.2 else None]
+
+def generate_workbooks(folder, rows, seed=0):
+    """產生與實際牌價表相同形狀的活頁簿：標題列前有 0~3 列抬頭，欄名含空白/全形括號，
+    資料後有空白列與無規格的備註列；另產生一份整套搭配檔。回傳實際產生的資料列數"""
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    written, file_no, specs = 0, 0, []
+    while written < rows:
+        wb = openpyxl.Workbook(write_only=True)
+        for sheet_no in range(SHEETS_PER_FILE):
+            if written >= rows: break
+            ws = wb.create_sheet(f"系列{sheet_no + 1}")
+            for title_row in range(rng.randint(0, 3)): ws.append([f"2026年 經銷牌價表 ({file_no}-{sheet_no})"] if title_row == 0 else [])
+            header = list(rng.choice(HEADER_VARIANTS))
+            ws.append(header + ['備註'])
+            for i in range(min(ROWS_PER_SHEET, rows - written)):
+                row = make_row(rng, i + 1)
+                ws.append(row + ['' if rng.random() < 0.9 else '停產'])
+                if len(specs) < 2000: specs.append(row[1])
+            written += min(ROWS_PER_SHEET, rows - written)
+            ws.append([])
+            ws.append([None, None, None, None, '※ 以上價格未稅', None])
+            for _ in range(3): ws.append([])
+        wb.save(os.path.join(folder, f"牌價_{file_no:03d}.xlsx"))
+        file_no += 1
+
+    wb = openpyxl.Workbook(write_only=True)
+    for series_no in range(20):
+        ws = wb.create_sheet(f"整套_{series_no:02d}")
+        ws.append(['組合名稱', '規格', '數量', '備註'])
+        for bundle_no in range(5):
+            for spec in rng.sample(specs, min(len(specs), 4)): ws.append([f"組合{bundle_no + 1}", spec, rng.randint(1, 4), None])
+    wb.create_sheet('DATA').append(['忽略'])
+    wb.save(os.path.join(folder, data_merger.COMBINATION_FILE))
+    return written
+
+# === 記憶體版 gspread ===
+class MemoryWorksheet:
+    """只實作 data_merger / app 用到的 gspread Worksheet 介面，資料放在 list of list"""
+    def __init__(self, title, sheet_id, rows=1000, cols=26):
+        self.title, self.id = title, sheet_id
+        self.grid = [[''] * cols for _ in range(rows)]
+
+    @property
+    def row_count(self): return len(self.grid)
+
+    @property
+    def col_count(self): return len(self.grid[0]) if self.grid else 0
+
+    def get_all_values(self):
+        values = [row[:] for row in self.grid]
+        while values and all(v == '' for v in values[-1]): values.pop()
+        width = max((max((i + 1 for i, v in enumerate(row) if v != ''), default=0) for row in values), default=0)
+        return [row[:width] for row in values]
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        if not values: return []
+        header = values[0]
+        return [dict(zip(header, row)) for row in values[1:]]
+
+    def resize(self, rows=None, cols=None):
+        rows, cols = rows or self.row_count, cols or self.col_count
+        self.grid = [(row + [''] * cols)[:cols] for row in self.grid[:rows]]
+        self.grid += [[''] * cols for _ in range(rows - len(self.grid))]
+
+    def update(self, values=None, range_name='A1'):
+        start = int(range_name.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ')) - 1
+        for i, row in enumerate(values):
+            self.grid[start + i][:len(row)] = [str(v) for v in row]
+
+    def cell(self, row, col):
+        return gspread.cell.Cell(row, col, self.grid[row - 1][col - 1])
+
+    def update_cell(self, row, col, value):
+        self.grid[row - 1][col - 1] = str(value)
+
+    def append_rows(self, rows):
+        for row in rows: self.grid.append([str(v) for v in row] + [''] * (self.col_count - len(row)))
+
+    def apply(self, request):
+        kind, body = next(iter(request.items()))
+        if kind == 'insertDimension':
+            r = body['range']
+            self.grid[r['startIndex']:r['startIndex']] = [[''] * self.col_count for _ in range(r['endIndex'] - r['startIndex'])]
+        elif kind == 'deleteDimension':
+            del self.grid[body['range']['startIndex']:body['range']['endIndex']]
+        elif kind == 'appendDimension':
+            self.grid += [[''] * self.col_count for _ in range(body['length'])]
+        elif kind == 'updateCells':
+            start = body['start']['rowIndex']
+            for i, row in enumerate(body['rows']):
+                self.grid[start + i][:len(row['values'])] = [c['userEnteredValue']['stringValue'] for c in row['values']]
+
+class MemorySpreadsheet:
+    def __init__(self):
+        self.sheets = [MemoryWorksheet('Sheet1', 0), MemoryWorksheet('Users', 1, rows=10, cols=4)]
+        self.batch_calls = 0
+
+    @property
+    def sheet1(self): return self.sheets[0]
+
+    def worksheet(self, title):
+        for ws in self.sheets:
+            if ws.title == title: return ws
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def add_worksheet(self, title, rows, cols):
+        ws = MemoryWorksheet(title, len(self.sheets), int(rows), int(cols))
+        self.sheets.append(ws)
+        return ws
+
+    def batch_update(self, body):
+        self.batch_calls += 1
+        for request in body['requests']:
+            payload = next(iter(request.values()))
+            sheet_id = payload.get('sheetId', payload.get('range', payload.get('start', {})).get('sheetId'))
+            self.sheets[sheet_id].apply(request)
+
+class MemoryClient:
+    def __init__(self): self.spreadsheet = MemorySpreadsheet()
+    def open(self, name): return self.spreadsheet
+
+# 記憶體版不占 Google 配額，量測時不做排隊節流
+UNLIMITED = 10 ** 9
+
+# === 計時 ===
+def measure(fn, repeat):
+    """執行 repeat 次，回傳 (最後一次的結果, 毫秒統計)"""
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return result, {'runs': repeat, 'min_ms': round(min(samples), 2), 'median_ms': round(float(np.median(samples)), 2), 'max_ms': round(max(samples), 2)}
+
+def parse_folder(folder, workers):
+    paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith('.xlsx') and f != data_merger.COMBINATION_FILE]
+    frames = []
+    for _, sheets, _, error in data_merger.load_workbooks(paths, 'general', data_merger.parse_general_workbook, {}, False, workers):
+        if error: raise error
+        frames += [df for _, df in sheets]
+    return pd.concat(frames, ignore_index=True).fillna("")
+
+def prepare_cards(df, rows):
+    """與 render_search 每次 rerun 的工作相同：取出一頁資料列並產生按鈕 key"""
+    page = rows[:CARD_PAGE_SIZE]
+    return [(row_key(row), row['經銷價_顯示']) for row in df.iloc[page].to_dict('records')]
+
+def run_size(rows, repeat, workers, seed, work_dir):
+    folder = os.path.join(work_dir, f"excel_{rows}")
+    start = time.perf_counter()
+    written = generate_workbooks(folder, rows, seed)
+    print(f"--- {written} 列 (產生活頁簿 {time.perf_counter() - start:.1f}s) ---")
+    results = {}
+
+    # 1. 合併：解析活頁簿、上傳 (完整覆寫 / 少量變動的差異上傳)
+    merged, results['merge.parse'] = measure(lambda: parse_folder(folder, 1), repeat)
+    if workers > 1: _, results[f'merge.parse_x{workers}'] = measure(lambda: parse_folder(folder, workers), repeat)
+    _, results['merge.parse_combinations'] = measure(lambda: data_merger.parse_combination_workbook(os.path.join(folder, data_merger.COMBINATION_FILE)), repeat)
+    client = MemoryClient()
+    sh = client.open(data_merger.GOOGLE_SHEET_NAME)
+    _, results['merge.upload_full'] = measure(lambda: data_merger.upload_table(sh, sh.sheet1, merged, mode='full'), 1)
+    changed = merged.copy()
+    changed.loc[changed.index[::100], '經銷價'] = '9,999'
+    _, results['merge.upload_diff'] = measure(lambda: data_merger.upload_table(sh, sh.sheet1, changed, data_merger.UPLOAD_KEY_COLUMNS), 1)
+
+    # 2. 載入：Sheets 下載路徑與本機快照路徑
+    _, results['load.sheets_records'] = measure(lambda: pd.DataFrame(sh.sheet1.get_all_records()).astype(str), repeat)
+    snapshot_dir = os.path.join(work_dir, f"snapshot_{rows}")
+    _, results['load.snapshot_write'] = measure(lambda: write_snapshot(changed, None, 'bench', snapshot_dir), 1)
+    files, results['load.snapshot_read'] = measure(lambda: read_snapshot(snapshot_dir), repeat)
+
+    # 3. 價格清洗與索引
+    raw = pd.DataFrame(sh.sheet1.get_all_records()).astype(str)
+    catalog, results['prices.prepare'] = measure(lambda: compact_catalog(prepare_prices(raw.copy())), repeat)
+    index, results['index.ngram'] = measure(lambda: NgramIndex(catalog), 1)
+    fuzzy, results['index.fuzzy'] = measure(lambda: FuzzyIndex(catalog), 1)
+    _, results['index.parts'] = measure(lambda: PartLookup(catalog), repeat)
+    comb = pd.concat([df for _, df in data_merger.parse_combination_workbook(os.path.join(folder, data_merger.COMBINATION_FILE))], ignore_index=True)
+    _, results['index.bundles'] = measure(lambda: BundleBook(comb, catalog), repeat)
+
+    # 4. 查詢：搜尋、卡片資料、批量報價
+    search_repeat = repeat * len(SEARCH_TERMS)
+    terms = iter(SEARCH_TERMS * repeat)
+    # 與 App 相同，只排序第一頁
+    _, results['search.ranked'] = measure(lambda: ranked_positions(catalog, index, fuzzy, next(terms), CARD_PAGE_SIZE), search_repeat)
+    hits = [ranked_positions(catalog, index, fuzzy, t, CARD_PAGE_SIZE)[0] for t in SEARCH_TERMS]
+    pages = iter(hits * repeat)
+    _, results['render.card_page'] = measure(lambda: prepare_cards(catalog, next(pages)), search_repeat)
+    parts = PartLookup(catalog)
+    rng = random.Random(seed)
+    bom_text = "\n".join(f"{spec}\t{rng.randint(1, 10)}" for spec in rng.choices(catalog['規格'].tolist(), k=BOM_LINES))
+    _, results['bom.quote'] = measure(lambda: parts.quote(parse_bom_text(bom_text)), repeat)
+
+    for stage, stat in results.items(): print(f" {stage:<28} {stat['median_ms']:>10.1f} ms")
+    return {'rows': written, 'snapshot_rows': len(files.catalog) if files else 0, 'results': results}
+
+def git_revision():
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception: return None
+
+def compare(current, baseline_path, threshold):
+    """與前一次的 JSON 結果比較，列出中位數變慢超過 threshold 倍的階段"""
+    with open(baseline_path, encoding='utf-8') as f: baseline = json.load(f)
+    old = {(run['rows'], stage): stat['median_ms'] for run in baseline['runs'] for stage, stat in run['results'].items()}
+    regressions = []
+    print(f"--- 與 {baseline_path} ({baseline.get('revision')}) 比較 ---")
+    for run in current['runs']:
+        for stage, stat in run['results'].items():
+            before = old.get((run['rows'], stage))
+            if not before: continue
+            ratio = stat['median_ms'] / before
+            mark = " ⚠️" if ratio > threshold else ""
+            print(f" {run['rows']:>7} {stage:<28} {before:>10.1f} -> {stat['median_ms']:>10.1f} ms ({ratio:.2f}x){mark}")
+            if ratio > threshold: regressions.append((run['rows'], stage, ratio))
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="以合成牌價資料量測合併、載入、搜尋與報價的耗時")
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help="資料列數 (可指定多個，例如 1000 100000 500000)")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="每個階段重複次數，取中位數")
+    parser.add_argument('--workers', type=int, default=1, help="另外量測平行解析的 process 數 (1 為不量測)")
+    parser.add_argument('--seed', type=int, default=0, help="亂數種子，相同種子產生相同資料")
+    parser.add_argument('--out', default='benchmark_result.json', help="結果 JSON 路徑")
+    parser.add_argument('--compare', help="前一版的結果 JSON，比較各階段耗時")
+    parser.add_argument('--threshold', type=float, default=1.2, help="變慢超過幾倍視為退步 (搭配 --compare)")
+    parser.add_argument('--keep', action='store_true', help="保留產生的活頁簿與快照")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    data_merger.SHEETS = SheetsGateway(read_per_minute=UNLIMITED, write_per_minute=UNLIMITED, burst=UNLIMITED)
+    work_dir = tempfile.mkdtemp(prefix='price_bench_')
+    report = {
+        'revision': git_revision(),
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'pandas': pd.__version__, 'numpy': np.__version__, 'cpu_count': os.cpu_count(),
+        'seed': args.seed, 'repeat': args.repeat, 'runs': [],
+    }
+    try:
+        for rows in args.rows: report['runs'].append(run_size(rows, args.repeat, args.workers, args.seed, work_dir))
+    finally:
+        if args.keep: print(f"合成資料保留在 {work_dir}")
+        else: shutil.rmtree(work_dir, ignore_errors=True)
+    with open(args.out, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ 結果已寫入 {args.out}")
+    if args.compare and compare(report, args.compare, args.threshold): return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
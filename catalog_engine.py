@@ -0,0 +1,466 @@
+import re
+import sys
+import time
+import hashlib
+import threading
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import gspread
+from perf_metrics import METRICS
+from catalog_snapshot import SNAPSHOT_DIR, prepare_prices, needs_prices, compact_catalog, read_snapshot
+
+# === 設定區 ===
+BUNDLE_SERIES_COLUMN = '系列'                    # data_merger 以分頁名稱填入
+BUNDLE_NAME_COLUMNS = ['組合名稱', '組合']        # 同一系列內有多組搭配時的組合名稱欄
+BUNDLE_QTY_COLUMNS = ['數量', 'QTY', 'Qty']      # 元件數量欄，沒有時視為 1
+ROW_KEY_COLUMNS = ['來源檔案', '來源分頁', 'NO.', '規格']  # 決定資料列識別碼 (卡片按鈕 key) 的欄位
+CATALOG_STAMP_POLL_INTERVAL = 15   # 輪詢版本戳記 (Users!D1) 的間隔 (秒)
+CATALOG_MAX_AGE = 3600              # 戳記未變動時，最久多少秒仍強制重新下載一次
+
+def spec_key(series):
+    """規格比對鍵：去頭尾空白並轉大寫"""
+    return series.fillna('').astype(str).str.strip().str.upper()
+
+def first_column(df, candidates):
+    return next((c for c in candidates if c in df.columns), None)
+
+def row_key(row):
+    """以資料列內容 (來源檔案/分頁/NO./規格) 產生穩定的元件 key，換頁或資料更新後按鈕不會錯置"""
+    ident = "|".join(str(row.get(c, '')) for c in ROW_KEY_COLUMNS)
+    return hashlib.md5(ident.encode('utf-8')).hexdigest()[:12]
+
+# === 搜尋索引 ===
+SEARCH_COLUMNS = ['NO.', '規格', '說明']
+REGEX_META_CHARS = set('.^$*+?{}[]\\|()')
+TEXT_SEPARATOR = '\x1f'  # 合併各欄比對字串時的分隔字元，查詢字串不會跨欄符合
+
+class NgramIndex:
+    """字元 n-gram 倒排索引：單字元 + 雙字元，英數型號與中文說明都適用"""
+    def __init__(self, df, columns=SEARCH_COLUMNS):
+        self.columns = [c for c in columns if c in df.columns]
+        self.size = len(df)
+        texts = [df[c].fillna('').astype(str).str.lower().tolist() for c in self.columns]
+        # 各欄小寫字串合併成一份 Arrow 陣列，候選列的最終比對交給 pyarrow 一次完成
+        self.text = pa.array([TEXT_SEPARATOR.join(row) for row in zip(*texts)] if texts else [], type=pa.string())
+        postings = {}
+        for pos in range(self.size):
+            grams = set()
+            for column in texts:
+                t = column[pos]
+                grams.update(t)
+                grams.update(t[i:i + 2] for i in range(len(t) - 1))
+            for g in grams:
+                postings.setdefault(g, []).append(pos)
+        self.postings = {g: np.asarray(p, dtype=np.int64) for g, p in postings.items()}
+
+    @staticmethod
+    def supports(term):
+        """含正規表示式符號的查詢交給原本的 str.contains 處理"""
+        return not (set(term) & REGEX_META_CHARS)
+
+    def search(self, term):
+        """回傳符合的列位置 (遞增排序)，結果與 str.contains(case=False) 相同"""
+        q = term.lower()
+        # 1~2 個字元的查詢本身就是一個 n-gram，倒排列表即為答案，不必再比對
+        if len(q) <= 2: return self.postings.get(q, np.empty(0, dtype=np.int64))
+        lists = []
+        for g in {q[i:i + 2] for i in range(len(q) - 1)}:
+            p = self.postings.get(g)
+            if p is None: return np.empty(0, dtype=np.int64)
+            lists.append(p)
+        # 每個雙字元都出現的列：以 bincount 一次算交集，不逐一排序合併
+        candidates = np.flatnonzero(np.bincount(np.concatenate(lists), minlength=self.size) == len(lists))
+        if not len(candidates): return candidates
+        # n-gram 交集只是候選，仍需確認整段字串確實出現在同一欄位
+        hits = pc.match_substring(self.text.take(pa.array(candidates)), q)
+        return candidates[hits.to_numpy(zero_copy_only=False)]
+
+def exact_positions(df, index, term):
+    """子字串符合的列位置 (遞增)"""
+    if NgramIndex.supports(term): return index.search(term)
+    valid_search = [c for c in SEARCH_COLUMNS if c in df.columns]
+    mask = df[valid_search].apply(lambda x: x.str.contains(term, case=False, na=False)).any(axis=1)
+    return np.flatnonzero(mask.to_numpy())
+
+def ranked_positions(df, index, fuzzy, term, limit=None):
+    """依相關度排序的前 limit 個列位置與符合總數：子字串符合的列在前，相似型號接在後面"""
+    return fuzzy.search(term, exact_positions(df, index, term), limit)
+
+# === 整套搭配 ===
+class BundleBook:
+    """Combinations 分頁的組合索引：元件以規格對應 sheet1 價格，載入時就算好每組的牌價/經銷價合計"""
+    def __init__(self, comb_df, catalog_df):
+        self.lines = self._build_lines(comb_df, catalog_df)
+        self.totals = self._build_totals(self.lines)
+        # (系列, 組合) -> 元件列位置
+        self.groups = {key: np.asarray(pos) for key, pos in self.lines.groupby(['系列', '組合'], sort=False).indices.items()}
+
+    @staticmethod
+    def _build_lines(comb_df, catalog_df):
+        columns = ['系列', '組合', '規格', '說明', '數量', '牌價_數值', '經銷價_數值', '牌價小計', '經銷價小計', '已定價']
+        if comb_df is None or comb_df.empty or '規格' not in comb_df.columns or BUNDLE_SERIES_COLUMN not in comb_df.columns:
+            return pd.DataFrame(columns=columns)
+        spec = comb_df['規格'].fillna('').astype(str).str.strip()
+        keep = spec != ''
+        lines = pd.DataFrame({
+            '系列': comb_df[BUNDLE_SERIES_COLUMN].astype(str)[keep].to_numpy(),
+            '規格': spec[keep].to_numpy(),
+        })
+        name_col = first_column(comb_df, BUNDLE_NAME_COLUMNS)
+        # 沒有組合名稱欄時，一個系列 (分頁) 就是一組搭配
+        lines['組合'] = comb_df[name_col].fillna('').astype(str).str.strip()[keep].to_numpy() if name_col else lines['系列']
+        lines['組合'] = lines['組合'].where(lines['組合'] != '', lines['系列'])
+        qty_col = first_column(comb_df, BUNDLE_QTY_COLUMNS)
+        qty = pd.to_numeric(comb_df[qty_col], errors='coerce')[keep].to_numpy() if qty_col else np.ones(len(lines))
+        lines['數量'] = np.where(np.isnan(qty), 1.0, qty)
+
+        # 同一規格出現多次時以 sheet1 第一筆為準 (與搜尋結果的順序一致)
+        prices = pd.DataFrame({
+            '規格鍵': spec_key(catalog_df['規格']) if '規格' in catalog_df.columns else pd.Series(dtype=str),
+            '說明': catalog_df['說明'].astype(str) if '說明' in catalog_df.columns else '',
+            '牌價_數值': catalog_df['牌價_數值'] if '牌價_數值' in catalog_df.columns else np.nan,
+            '經銷價_數值': catalog_df['經銷價_數值'] if '經銷價_數值' in catalog_df.columns else np.nan,
+        }).drop_duplicates('規格鍵')
+        lines['規格鍵'] = spec_key(lines['規格'])
+        lines = lines.merge(prices, on='規格鍵', how='left')
+        lines['說明'] = lines['說明'].fillna('')
+        lines['牌價小計'] = lines['數量'] * lines['牌價_數值']
+        lines['經銷價小計'] = lines['數量'] * lines['經銷價_數值']
+        lines['已定價'] = lines['經銷價_數值'].notna()
+        return lines[columns]
+
+    @staticmethod
+    def _build_totals(lines):
+        grouped = lines.groupby(['系列', '組合'], sort=False)
+        totals = grouped.agg(
+            牌價合計=('牌價小計', 'sum'),
+            經銷價合計=('經銷價小計', 'sum'),
+            品項數=('規格', 'size'),
+            已定價品項=('已定價', 'sum'),
+        ).reset_index()
+        # 只要有一個元件沒有經銷價，合計就不完整，不提供試算
+        totals['完整報價'] = totals['已定價品項'] == totals['品項數']
+        return totals
+
+    def series_names(self):
+        return self.totals['系列'].drop_duplicates().tolist()
+
+    def bundles(self, series):
+        return self.totals[self.totals['系列'] == series]
+
+    def components(self, series, bundle):
+        pos = self.groups.get((series, bundle))
+        if pos is None: return self.lines.iloc[0:0]
+        return self.lines.iloc[pos]
+
+# === 批量報價 (BOM) ===
+BOM_SPEC_COLUMNS = ['規格', '型號', '品名規格', 'NO.', 'Part No.', 'PartNo']
+BOM_QTY_COLUMNS = ['數量', 'QTY', 'Qty', 'qty']
+BOM_DISCOUNT_COLUMNS = ['折數', '折扣']
+BOM_RESULT_COLUMNS = ['列號', '輸入', '數量', '狀態', '規格', '說明', '牌價', '經銷價', '折數', '單價', '小計']
+# 數量 / 折數：可含千分位逗號，折數可帶 %
+BOM_NUMBER_PATTERN = re.compile(r'[+-]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?|[+-]?\.\d+')
+
+def parse_bom_text(text):
+    """貼上的 BOM 文字：Excel 複製貼上 (tab 分隔) 為「規格 數量 折數」三欄；
+    以空白分隔時只把最後一個數字當數量 (規格本身可含空白，不猜折數)，逗號不當分隔符號"""
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line: continue
+        if '\t' in line: fields = [f.strip() for f in line.split('\t')]
+        else:
+            fields = line.split()
+            if len(fields) > 1 and BOM_NUMBER_PATTERN.fullmatch(fields[-1]):
+                fields = [" ".join(fields[:-1]), fields[-1]]
+            else: fields = [line]
+        records.append((fields + ['', ''])[:3])
+    return pd.DataFrame(records, columns=['規格', '數量', '折數'])
+
+def parse_bom_number(value, default):
+    """空白為 default，'1,000'、'95%' 可解析，其他無法解析的值為 NaN"""
+    if value is None or (isinstance(value, float) and np.isnan(value)): return default
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_)): return float(value)
+    text = str(value).strip()
+    if not text: return default
+    text = text[:-1].strip() if text.endswith('%') else text
+    return float(text.replace(',', '')) if BOM_NUMBER_PATTERN.fullmatch(text) else np.nan
+
+def normalize_bom_frame(df):
+    """上傳的 Excel/CSV：依欄名找出規格、數量、折數欄；找不到標題時取前兩欄"""
+    df = df.rename(columns=lambda c: str(c).strip())
+    spec_col = first_column(df, BOM_SPEC_COLUMNS) or df.columns[0]
+    qty_col = first_column(df, BOM_QTY_COLUMNS) or (df.columns[1] if len(df.columns) > 1 else None)
+    disc_col = first_column(df, BOM_DISCOUNT_COLUMNS)
+    return pd.DataFrame({
+        '規格': df[spec_col].fillna('').astype(str),
+        '數量': df[qty_col] if qty_col else 1,
+        '折數': df[disc_col] if disc_col else '',
+    })
+
+class PartLookup:
+    """規格 / NO. 的雜湊索引，整份 BOM 以一次 join 對應到牌價資料"""
+    def __init__(self, catalog_df):
+        self.df = catalog_df
+        self.spec = self._key_table(catalog_df, '規格')
+        self.no = self._key_table(catalog_df, 'NO.')
+
+    @staticmethod
+    def _key_table(df, column):
+        """鍵 -> (第一筆位置, 筆數, 不同經銷價的數量)"""
+        if column not in df.columns: return pd.DataFrame(columns=['位置', '筆數', '價格數']).rename_axis('鍵')
+        keys = pd.DataFrame({
+            '鍵': spec_key(df[column]).to_numpy(),
+            '位置': np.arange(len(df)),
+            '價格': df['經銷價_數值'].to_numpy() if '經銷價_數值' in df.columns else np.nan,
+        })
+        keys = keys[keys['鍵'] != '']
+        table = keys.groupby('鍵', sort=False).agg(位置=('位置', 'first'), 筆數=('位置', 'size'))
+        # 不同價格數 (NaN 也算一種)：先去掉重複的 (鍵, 價格) 再計數，避免逐組呼叫 nunique
+        table['價格數'] = keys.drop_duplicates(['鍵', '價格']).groupby('鍵', sort=False).size()
+        return table
+
+    def quote(self, bom, discount=100.0):
+        """回傳報價明細：狀態為 符合 / 多筆符合 (同鍵對到多個不同價格) / 需洽詢 (無經銷價) / 查無 / 數量錯誤 / 折數錯誤。
+        只有「符合」的行有小計，其他行不計入合計"""
+        key = spec_key(bom['規格']).to_numpy()
+        hits = self.spec.reindex(key)
+        # 規格找不到時再用 NO. 比對
+        missing = hits['位置'].isna().to_numpy()
+        if missing.any():
+            hits.loc[missing] = self.no.reindex(key[missing]).to_numpy()
+        pos = hits['位置'].to_numpy(dtype=float)
+        found = ~np.isnan(pos)
+        take = np.where(found, pos, 0).astype(np.int64)
+
+        def pick(column, fill):
+            if column not in self.df.columns or not len(self.df): return np.full(len(bom), fill, dtype=object)
+            # 只取出 BOM 對到的列，不轉換整欄
+            return np.where(found, self.df[column].take(take).to_numpy(dtype=object), fill)
+
+        # 只有空白才視為 1 個 / 整批折數，無法解析的值標示錯誤，不默默改成預設值
+        qty = np.array([parse_bom_number(v, 1.0) for v in bom['數量']], dtype=float)
+        disc = np.array([parse_bom_number(v, discount) for v in bom['折數']], dtype=float)
+        dealer = pick('經銷價_數值', np.nan).astype(float)
+        status = np.select(
+            [np.isnan(qty) | (qty <= 0), np.isnan(disc) | (disc < 0), ~found, hits['價格數'].to_numpy(dtype=float) > 1, np.isnan(dealer)],
+            ['數量錯誤', '折數錯誤', '查無', '多筆符合', '需洽詢'], default='符合')
+        unit = np.round(dealer * disc / 100)
+        return pd.DataFrame({
+            '列號': np.arange(1, len(bom) + 1),
+            '輸入': bom['規格'].to_numpy(),
+            '數量': qty,
+            '狀態': status,
+            '規格': pick('規格', ''),
+            '說明': pick('說明', ''),
+            '牌價': pick('牌價_數值', np.nan).astype(float),
+            '經銷價': dealer,
+            '折數': disc,
+            '單價': unit,
+            '小計': np.where(status == '符合', unit * qty, np.nan),
+        }, columns=BOM_RESULT_COLUMNS)
+
+# === 容錯搜尋 (三字元相似度) ===
+FUZZY_KEY_COLUMNS = ['規格', 'NO.']   # 型號欄：整段比對相似度
+FUZZY_TEXT_COLUMNS = ['說明']         # 說明欄：只看查詢字串被涵蓋的比例
+FUZZY_MIN_SCORE = 0.6                 # 非完全符合的列，分數需達此門檻才列入結果
+FUZZY_TEXT_WEIGHT = 0.6               # 只在說明中相似的列排在型號相似之後
+# 只去掉空白與 ASCII / 全形標點 (\W 在 Arrow 字串上不認得中文，不能直接用)
+FUZZY_STRIP_PATTERN = r'[\s!-/:-@\[-`{-~，、。；：（）／－＿]+'
+
+def normalize_key(series):
+    """比對鍵：轉小寫並去掉空白、連字號等符號，'FX5U-32M'、'fx5u 32m' 視為相同"""
+    return series.fillna('').astype(str).str.lower().str.replace(FUZZY_STRIP_PATTERN, '', regex=True)
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class FuzzyIndex:
+    """載入時預先建好三字元倒排索引；查詢時以 bincount 計算每列共有的三字元數，再取分數最高的列"""
+    def __init__(self, df, key_columns=FUZZY_KEY_COLUMNS, text_columns=FUZZY_TEXT_COLUMNS):
+        self.size = len(df)
+        key_columns = [c for c in key_columns if c in df.columns]
+        text_columns = [c for c in text_columns if c in df.columns]
+        keys = [normalize_key(df[c]).tolist() for c in key_columns]
+        texts = [normalize_key(df[c]).tolist() for c in text_columns]
+        # 最短的型號鍵，用來讓同分時較精簡的型號排前面
+        self.key_length = np.array([min((len(k[pos]) for k in keys if k[pos]), default=0) for pos in range(self.size)], dtype=np.int32)
+        self.key_grams = np.zeros(self.size, dtype=np.int32)
+        self.keys, key_postings, text_postings = keys, {}, {}
+        for pos in range(self.size):
+            grams = set()
+            for k in keys: grams |= trigrams(k[pos])
+            self.key_grams[pos] = len(grams)
+            for g in grams: key_postings.setdefault(g, []).append(pos)
+            grams = set()
+            for t in texts: grams |= trigrams(t[pos])
+            for g in grams: text_postings.setdefault(g, []).append(pos)
+        self.key_postings = {g: np.asarray(p, dtype=np.int32) for g, p in key_postings.items()}
+        self.text_postings = {g: np.asarray(p, dtype=np.int32) for g, p in text_postings.items()}
+
+    def _counts(self, postings, grams):
+        lists = [postings[g] for g in grams if g in postings]
+        if not lists: return np.zeros(self.size, dtype=np.int64)
+        return np.bincount(np.concatenate(lists), minlength=self.size)
+
+    def scores(self, term):
+        """每列的相似度 (0~1)：型號取 Jaccard 與涵蓋率的平均，說明只取涵蓋率並降權"""
+        query = re.sub(FUZZY_STRIP_PATTERN, '', str(term).lower())
+        grams = trigrams(query)
+        if not grams or not self.size: return None
+        m = len(grams)
+        key_hits = self._counts(self.key_postings, grams)
+        text_hits = self._counts(self.text_postings, grams)
+        jaccard = key_hits / np.maximum(m + self.key_grams - key_hits, 1)
+        return np.maximum((jaccard + key_hits / m) / 2, FUZZY_TEXT_WEIGHT * text_hits / m)
+
+    def search(self, term, exact=None, limit=None):
+        """回傳 (依分數排序的前 limit 個列位置, 符合總數)：exact (子字串符合的列) 一律保留並排在前面，其餘相似列依門檻補上。
+        只排序前 limit 名，總數直接計數，結果與全部排序後再切片相同"""
+        exact = np.empty(0, dtype=np.int64) if exact is None else np.asarray(exact, dtype=np.int64)
+        score = self.scores(term)
+        if score is None:
+            # 查詢太短無法取三字元：完全符合的列依 (型號長度, 原始順序) 排序
+            if not self.size: return exact, len(exact)
+            return exact[top_order(self.key_length[exact].astype(np.int64) * self.size + exact, limit)], len(exact)
+        score = score.astype(np.float64)
+        score[exact] += 1.0
+        candidates = np.flatnonzero(score >= FUZZY_MIN_SCORE)
+        total = len(candidates)
+        if limit and total > limit:
+            # 先留下分數不低於第 limit 名的列 (含同分)，再完整排序這一小部分
+            neg = -score[candidates]
+            candidates = candidates[neg <= np.partition(neg, limit - 1)[limit - 1]]
+        # 分數高者優先，同分時型號較短者優先，再依原始順序
+        order = np.lexsort((candidates, self.key_length[candidates], -score[candidates]))
+        return candidates[order[:limit] if limit else order].astype(np.int64), total
+
+def top_order(keys, limit=None):
+    """不重複整數鍵由小到大的前 limit 個索引"""
+    if limit and len(keys) > limit:
+        part = np.argpartition(keys, limit - 1)[:limit]
+        return part[np.argsort(keys[part])]
+    return np.argsort(keys)
+
+# === 牌價資料載入 ===
+CatalogSnapshot = namedtuple('CatalogSnapshot', ['df', 'index', 'fuzzy', 'bundles', 'parts', 'update_date', 'loaded_at'])
+
+def direct_call(name, fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+class SheetsSource:
+    """牌價資料的 Sheets 來源；worksheet(title) 回傳分頁 (None 代表第一頁)，call 為 gspread 呼叫的包裝 (配額、重試)"""
+    def __init__(self, worksheet, call=direct_call):
+        self.worksheet = worksheet
+        self.call = call
+
+    @classmethod
+    def from_client(cls, client_factory, sheet_name, call=direct_call):
+        """只給 client factory 時 (App 以外的程式)，試算表與分頁開啟一次後重用"""
+        cache, lock = {}, threading.Lock()
+
+        def worksheet(title=None):
+            with lock:
+                if title not in cache:
+                    if 'spreadsheet' not in cache:
+                        client = client_factory()
+                        if not client: return None
+                        cache['spreadsheet'] = call("open", client.open, sheet_name)
+                    sh = cache['spreadsheet']
+                    cache[title] = call("sheet1", getattr, sh, "sheet1") if title is None else call("worksheet", sh.worksheet, title)
+                return cache[title]
+        return cls(worksheet, call)
+
+    def fetch_catalog(self):
+        ws = self.worksheet()
+        if not ws: return None
+        return pd.DataFrame(self.call("get_all_records", ws.get_all_records)).astype(str)
+
+    def fetch_combinations(self):
+        try: ws = self.worksheet("Combinations")
+        except gspread.exceptions.WorksheetNotFound: return None
+        if not ws: return None
+        return pd.DataFrame(self.call("get_all_records", ws.get_all_records)).astype(str)
+
+    def fetch_update_date(self):
+        ws = self.worksheet("Users")
+        if not ws: return ""
+        date_val = self.call("cell", ws.cell, 1, 4).value
+        return date_val if date_val else "未知"
+
+def load_catalog_frame(source, update_date, snapshot_dir=SNAPSHOT_DIR):
+    """優先使用 data_merger 寫出的本機欄式快照 (戳記相符，或暫時讀不到戳記時)，否則從 Sheets 下載"""
+    with METRICS.timed("catalog.read_snapshot"): files = read_snapshot(snapshot_dir)
+    if files is not None and (not update_date or update_date == files.stamp):
+        return files.catalog, files.combinations
+    df = source.fetch_catalog()
+    if df is None: return None, None
+    # 整套搭配是附加資料：讀不到 (配額用盡、標題列重複/空白等) 時照樣用牌價建快照，只是沒有組合
+    try: comb_df = source.fetch_combinations()
+    except Exception as e:
+        print(f"⚠️ Combinations 分頁讀取失敗，本次不載入整套搭配：{e!r}", file=sys.stderr)
+        comb_df = None
+    return df, comb_df
+
+def build_snapshot(df, update_date, comb_df=None):
+    if needs_prices(df):
+        with METRICS.timed("catalog.prices"): df = prepare_prices(df)
+    with METRICS.timed("catalog.index"):
+        df = compact_catalog(df)
+        return CatalogSnapshot(df, NgramIndex(df), FuzzyIndex(df), BundleBook(comb_df, df), PartLookup(df), update_date, time.time())
+
+def search_positions(catalog, term, limit=None):
+    """回傳 (依相關度排序的前 limit 個列位置, 符合總數)；子字串符合的列在前，打錯字或少打符號的相似型號接在後面。
+    分頁時傳入 limit = 目前頁尾的位置，只排序需要顯示的部分。所有使用者共用同一份 DataFrame，不複製資料"""
+    total = len(catalog.df)
+    if not term: return np.arange(min(limit, total) if limit else total), total
+    with METRICS.timed("search"): return ranked_positions(catalog.df, catalog.index, catalog.fuzzy, term, limit)
+
+class CatalogStore:
+    """牌價快照：背景執行緒輪詢版本戳記，有變動才重建並整份替換，使用者永遠直接讀記憶體"""
+    def __init__(self, source, poll_interval=CATALOG_STAMP_POLL_INTERVAL, max_age=CATALOG_MAX_AGE, snapshot_dir=SNAPSHOT_DIR):
+        self.source = source
+        self.poll_interval = poll_interval
+        self.max_age = max_age
+        self.snapshot_dir = snapshot_dir
+        self.snapshot = build_snapshot(pd.DataFrame(), "")
+        self._ok = self.refresh()
+        self._thread = threading.Thread(target=self._run, name="catalog-refresher", daemon=True)
+        self._thread.start()
+
+    def refresh(self, update_date=None):
+        """重建快照；失敗時保留上一份成功的快照並回傳 False"""
+        try:
+            # 先讀戳記再讀資料：data_merger 先上傳資料才寫戳記，新戳記必定對應完整的新資料
+            if update_date is None:
+                try: update_date = self.source.fetch_update_date()
+                except Exception: pass
+            with METRICS.timed("catalog.load"): df, comb_df = load_catalog_frame(self.source, update_date, self.snapshot_dir)
+            if df is None: return False
+            if update_date is None: update_date = self.snapshot.update_date or "未知"
+            # 單一屬性指派即完成替換，讀取端不會看到建到一半的資料
+            self.snapshot = build_snapshot(df, update_date, comb_df)
+            return True
+        except Exception: return False
+
+    @property
+    def ok(self):
+        return self._ok
+
+    def is_stale(self, update_date):
+        if not self._ok: return True
+        if update_date != self.snapshot.update_date: return True
+        return time.time() - self.snapshot.loaded_at > self.max_age
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try: update_date = self.source.fetch_update_date()
+            except Exception: continue
+            stale = self.is_stale(update_date)
+            METRICS.lookup("牌價快照", miss=stale)
+            if stale:
+                self._ok = self.refresh(update_date)
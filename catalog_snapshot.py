@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import uuid
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# === 設定區 ===
+# data_merger.py 寫入、app.py 以 memory-map 讀取的欄式快照 (Arrow IPC，不壓縮才能零複製映射)
+SNAPSHOT_DIR = os.environ.get('PRICE_SNAPSHOT_DIR', './catalog_snapshot')
+SNAPSHOT_MANIFEST = 'manifest.json'
+SNAPSHOT_SCHEMA_VERSION = 2  # 欄位型別或內容變動時遞增，舊快照會被拒絕並重建
+SNAPSHOT_KEEP_VERSIONS = 2  # 保留上一版，讓仍在映射舊檔的 worker 不受影響
+
+PRICE_COLUMNS = ['牌價', '經銷價']
+CATEGORY_COLUMNS = ['來源檔案', '來源分頁', '訂購品(V)']  # 低基數欄位以 categorical 儲存
+
+SnapshotFiles = namedtuple('SnapshotFiles', ['catalog', 'combinations', 'stamp', 'version'])
+
+# === 價格欄位 ===
+def parse_price_series(series):
+    """向量化的價格清洗：去掉數字與小數點以外的字元再轉 float，無法解析者為 NaN"""
+    cleaned = series.fillna('').astype(str).str.replace(r'[^\d.]', '', regex=True)
+    return pd.to_numeric(cleaned, errors='coerce').astype(np.float64)
+
+def prepare_prices(df):
+    """新增 '<欄位>_數值' 浮點欄、'經銷價_顯示' 字串欄與 '需洽詢' 旗標，查詢時只需切片"""
+    for col in PRICE_COLUMNS:
+        if col in df.columns: df[f'{col}_數值'] = parse_price_series(df[col])
+    if '經銷價_數值' in df.columns:
+        dist_price = df['經銷價_數值']
+        df['需洽詢'] = dist_price.isna()
+        df['經銷價_顯示'] = dist_price.map(lambda v: "請洽詢" if pd.isna(v) else f"${v:,.0f}")
+    return df
+
+def needs_prices(df):
+    return '經銷價' in df.columns and '經銷價_數值' not in df.columns
+
+def compact_catalog(df):
+    """低基數欄位轉成 categorical (每列只存一個代碼)，價格欄已是 float 陣列"""
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].fillna('').astype(str).astype('category')
+    return df
+
+# === 快照讀寫 ===
+def to_arrow_table(df):
+    """逐欄轉成固定型別：categorical 存成 dictionary，數值欄保留 NaN (不轉成 null)，讀回時 float 欄可直接引用映射的記憶體"""
+    arrays, names = [], []
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype): arr = pa.array(series)
+        elif pd.api.types.is_bool_dtype(series): arr = pa.array(series.to_numpy(dtype=bool))
+        elif pd.api.types.is_numeric_dtype(series): arr = pa.array(series.to_numpy(dtype=np.float64))
+        else: arr = pa.array(series.fillna('').astype(str).tolist(), type=pa.string())
+        arrays.append(arr)
+        names.append(str(col))
+    return pa.Table.from_arrays(arrays, names=names)
+
+def write_arrow(table, path):
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer: writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def read_arrow(path):
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True)
+
+def write_snapshot(catalog_df, comb_df, stamp, snapshot_dir=SNAPSHOT_DIR):
+    """寫出新版本快照；資料檔先寫好，最後才替換 manifest，讀取端不會讀到寫一半的版本"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    version = time.strftime('%Y%m%d%H%M%S') + '-' + uuid.uuid4().hex[:6]
+    manifest = {'schema': SNAPSHOT_SCHEMA_VERSION, 'version': version, 'stamp': stamp, 'created_at': time.time()}
+    for name, df in (('catalog', catalog_df), ('combinations', comb_df)):
+        if df is None: continue
+        if name == 'catalog':
+            df = df.copy()
+            if needs_prices(df): df = prepare_prices(df)
+            df = compact_catalog(df)
+        file_name = f"{name}-{version}.arrow"
+        write_arrow(to_arrow_table(df), os.path.join(snapshot_dir, file_name))
+        manifest[name] = file_name
+        manifest[f'{name}_rows'] = len(df)
+    tmp_path = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(snapshot_dir, SNAPSHOT_MANIFEST))
+    prune_snapshots(snapshot_dir)
+    return manifest
+
+def prune_snapshots(snapshot_dir=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP_VERSIONS):
+    versions = sorted({name.split('-', 1)[1][:-len('.arrow')] for name in os.listdir(snapshot_dir) if name.endswith('.arrow')})
+    for version in versions[:-keep]:
+        for name in ('catalog', 'combinations'):
+            path = os.path.join(snapshot_dir, f"{name}-{version}.arrow")
+            try: os.remove(path)
+            except OSError: pass
+
+def read_manifest(snapshot_dir=SNAPSHOT_DIR):
+    path = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)
+    if not os.path.exists(path): return None
+    try:
+        with open(path, encoding='utf-8') as f: manifest = json.load(f)
+    except Exception: return None
+    return manifest if manifest.get('schema') == SNAPSHOT_SCHEMA_VERSION else None
+
+def read_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """以 memory-map 讀取目前版本的快照；不存在或格式不符時回傳 None"""
+    manifest = read_manifest(snapshot_dir)
+    if not manifest or 'catalog' not in manifest: return None
+    try:
+        catalog = read_arrow(os.path.join(snapshot_dir, manifest['catalog']))
+        combinations = read_arrow(os.path.join(snapshot_dir, manifest['combinations'])) if 'combinations' in manifest else None
+    except Exception: return None
+    return SnapshotFiles(catalog, combinations, manifest.get('stamp'), manifest['version'])
@@ -1,17 +1,48 @@
 import os
+import json
+import hashlib
+import math
+import itertools
+import argparse
+from difflib import SequenceMatcher
+from concurrent.futures import ProcessPoolExecutor
+import openpyxl
 import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import re
+from datetime import datetime, timezone, timedelta
+from catalog_snapshot import write_snapshot
+from sheets_gateway import SheetsGateway
 
 # === 設定區 ===
 GOOGLE_SHEET_NAME = '經銷牌價表_資料庫'
 JSON_KEY_FILE = 'service_account.json'
 EXCEL_FOLDER = './excel_files'
 COMBINATION_FILE = '整套搭配.xlsx' # 請確保這個檔案放在 excel_files 資料夾內
+CACHE_DIR = './.merge_cache'        # 已解析分頁的本機快取
+MANIFEST_FILE = os.path.join(CACHE_DIR, 'manifest.json')
+PARSER_VERSION = 3                  # 解析邏輯變動時遞增，讓舊快取自動失效
 
 # 一般查詢保留的欄位
 TARGET_COLUMNS = ['NO.', '規格', '牌價', '經銷價', '說明', '訂購品(V)']
+HEADER_SCAN_ROWS = 20  # 在前幾列中尋找標題列
+# pandas 預設的 na_values：pd.read_excel 會把資料列中這些字串當成空白 (標題列不受影響)
+EXCEL_NA_VALUES = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+# 差異上傳時用來比對列的鍵
+UPLOAD_KEY_COLUMNS = ['來源檔案', '來源分頁', 'NO.', '規格']
+UPLOAD_BATCH_CELLS = 20000  # 每次 batch_update 最多寫入的儲存格數
+
+# 所有 Sheets 呼叫共用配額：分批上傳時不會衝過每分鐘上限，429/5xx 自動退避重試
+SHEETS = SheetsGateway()
+
+def sheets_call(name, fn, *args, **kwargs):
+    return SHEETS.call(name, fn, *args, **kwargs)
+
+def get_tw_time():
+    tw_tz = timezone(timedelta(hours=8))
+    return datetime.now(tw_tz).strftime("%Y-%m-%d %H:%M:%S")
 
 def clean_header_name(header):
     if pd.isna(header): return ""
@@ -20,113 +51,436 @@ def clean_header_name(header):
     s = s.replace('（', '(').replace('）', ')')
     return s
 
-def find_header_row(file_path, sheet_name):
-    try:
-        df_temp = pd.read_excel(file_path, sheet_name=sheet_name, header=None, nrows=20)
-        for idx, row in df_temp.iterrows():
-            row_str = "".join([clean_header_name(x) for x in row.values])
-            if '規格' in row_str and ('經銷價' in row_str or '牌價' in row_str):
-                return idx
-    except: pass
+def find_header_row(rows):
+    """在前幾列中找出同時含「規格」與「經銷價/牌價」的標題列，找不到就用第 0 列"""
+    for idx, row in enumerate(rows):
+        row_str = "".join([clean_header_name(x) for x in row])
+        if '規格' in row_str and ('經銷價' in row_str or '牌價' in row_str):
+            return idx
     return 0
 
-def process_general_files(client):
-    """處理一般經銷牌價 Excel"""
+def cell_to_str(value):
+    """與 pd.read_excel(dtype=str) 相同的轉換：空白為 None，整數值的 float 不帶小數點 (NA 字串另由 split_header 處理)"""
+    if value is None or value == "": return None
+    if isinstance(value, float):
+        if math.isnan(value): return None
+        if value.is_integer(): return str(int(value))
+    return str(value)
+
+def iter_workbook(file_path):
+    """每個活頁簿只開啟一次，依序產生 (分頁名稱, 逐列 tuple 的 iterator)"""
+    if file_path.endswith('.xlsx'):
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets:
+                yield ws.title, ws.iter_rows(values_only=True)
+        finally: wb.close()
+    else:
+        # openpyxl 不支援 .xls，改由 pandas 一次讀入所有分頁
+        for sheet_name, df in pd.read_excel(file_path, sheet_name=None, header=None, dtype=object).items():
+            yield sheet_name, df.itertuples(index=False, name=None)
+
+def iter_data_rows(rows):
+    """逐列轉成字串；與 pandas 相同，尾端的全空列捨棄，中間的空列保留"""
+    pending = []
+    for row in rows:
+        values = [cell_to_str(v) for v in row]
+        if all(v is None for v in values):
+            pending.append(values)
+            continue
+        if pending:
+            yield from pending
+            pending = []
+        yield values
+
+def make_column_names(header):
+    """與 pandas 相同的欄名規則：空白欄為 'Unnamed: n'，重複欄名加上 .1、.2"""
+    names, seen = [], {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else: seen[name] = 0
+        names.append(name)
+    return names
+
+def split_header(rows, detect=True):
+    """從串流的前幾列找出標題列，回傳 (標題列, 其後的資料列 iterator)；整個分頁只讀一遍"""
+    rows = iter_data_rows(rows)
+    head = []
+    for row in rows:
+        head.append(row)
+        if not detect or len(head) >= HEADER_SCAN_ROWS: break
+    if not head: return None, iter(())
+    header_idx = find_header_row(head) if detect else 0
+    def body():
+        for row in itertools.chain(head[header_idx + 1:], rows):
+            yield [None if v in EXCEL_NA_VALUES else v for v in row]
+    return head[header_idx], body()
+
+# === 增量解析快取 ===
+def load_manifest():
+    if not os.path.exists(MANIFEST_FILE): return {}
+    try:
+        with open(MANIFEST_FILE, encoding='utf-8') as f: return json.load(f)
+    except Exception: return {}
+
+def save_manifest(manifest):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = MANIFEST_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_FILE)
+
+def file_digest(file_path, entry):
+    """大小與修改時間都沒變就沿用 manifest 裡的 sha256，否則重新計算"""
+    stat = os.stat(file_path)
+    if entry and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+        return entry['sha256']
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): h.update(chunk)
+    return h.hexdigest()
+
+def cache_path(file, digest, kind):
+    # 解析結果內含「來源檔案」欄位，所以檔名也要納入快取鍵
+    name_key = hashlib.sha256(file.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{kind}-v{PARSER_VERSION}-{name_key}-{digest}.pkl")
+
+def read_cache(file_path, kind, manifest, use_cache=True):
+    """更新 manifest；內容沒變的活頁簿回傳上次解析的結果，否則回傳 None"""
+    file = os.path.basename(file_path)
+    digest = file_digest(file_path, manifest.get(file))
+    stat = os.stat(file_path)
+    manifest[file] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest, 'kind': kind}
+    path = cache_path(file, digest, kind)
+    if use_cache and os.path.exists(path):
+        try: return pd.read_pickle(path)
+        except Exception: pass
+    return None
+
+def write_cache(file_path, kind, manifest, sheets):
+    file = os.path.basename(file_path)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    pd.to_pickle(sheets, cache_path(file, manifest[file]['sha256'], kind))
+
+def load_workbooks(file_paths, kind, parser, manifest, use_cache=True, workers=1):
+    """依檔案順序產生 (路徑, 分頁清單, 是否來自快取, 錯誤)；未命中快取的活頁簿交給 process pool 平行解析"""
+    cached, errors = {}, {}
+    for path in file_paths:
+        # 讀不到或被鎖住的檔案只算這個檔案失敗，其他檔案照常合併
+        try: cached[path] = read_cache(path, kind, manifest, use_cache)
+        except Exception as e: errors[path] = e
+    misses = [path for path in file_paths if path in cached and cached[path] is None]
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(misses))) if workers > 1 and len(misses) > 1 else None
+    try:
+        futures = {path: executor.submit(parser, path) for path in misses} if executor else {}
+        # 依原本的檔案順序取結果，合併結果與輸出訊息都和循序執行時相同
+        for path in file_paths:
+            if path in errors:
+                yield path, None, False, errors[path]
+                continue
+            if cached[path] is not None:
+                yield path, cached[path], True, None
+                continue
+            try:
+                sheets = futures[path].result() if executor else parser(path)
+                write_cache(path, kind, manifest, sheets)
+                yield path, sheets, False, None
+            except Exception as e:
+                yield path, None, False, e
+    finally:
+        if executor: executor.shutdown()
+
+def prune_cache(manifest, current_files):
+    """移除已不存在的檔案紀錄，以及沒有被引用的快取檔"""
+    for file in list(manifest):
+        if file not in current_files: del manifest[file]
+    keep = {os.path.basename(cache_path(f, e['sha256'], e['kind'])) for f, e in manifest.items()}
+    if not os.path.exists(CACHE_DIR): return
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith('.pkl') and name not in keep:
+            os.remove(os.path.join(CACHE_DIR, name))
+
+# === 活頁簿解析 ===
+def parse_general_workbook(file_path):
+    """解析一般牌價活頁簿，回傳 [(分頁名稱, 整理後的 DataFrame), ...]"""
+    file = os.path.basename(file_path)
+    sheets = []
+    for sheet_name, rows in iter_workbook(file_path):
+        header, body = split_header(rows)
+        if header is None: continue
+        names = [clean_header_name(c) for c in make_column_names(header)]
+        positions = {col: names.index(col) for col in TARGET_COLUMNS if col in names}
+        
+        # 只保留 TARGET_COLUMNS，邊讀邊建立欄位
+        columns = {col: [] for col in positions}
+        for row in body:
+            for col, pos in positions.items():
+                columns[col].append(row[pos] if pos < len(row) else None)
+        n_rows = len(next(iter(columns.values()))) if columns else 0
+        clean_df = pd.DataFrame({col: columns[col] if col in columns else [""] * n_rows for col in TARGET_COLUMNS},
+                                columns=TARGET_COLUMNS, dtype=object)
+        
+        if '規格' in clean_df.columns:
+            clean_df = clean_df[clean_df['規格'].str.strip() != '']
+            
+        if not clean_df.empty:
+            clean_df['來源檔案'] = file
+            clean_df['來源分頁'] = sheet_name
+            sheets.append((sheet_name, clean_df))
+    return sheets
+
+def parse_combination_workbook(comb_path):
+    """解析組合搭配活頁簿，每個分頁多加一個「系列」欄位"""
+    sheets = []
+    
+    # 假設組合檔的標題都在第 0 列 (通常是第一列)
+    # 我們把所有 Sheet 合併，但多加一個「系列」欄位
+    for sheet_name, rows in iter_workbook(comb_path):
+        # 跳過非數據頁
+        if sheet_name in ['DATA', '經銷價(總)']: continue
+        
+        # 讀取資料 (假設第一列是標題)
+        header, body = split_header(rows, detect=False)
+        if header is None: continue
+        names = make_column_names(header)
+        df = pd.DataFrame([row + [None] * (len(names) - len(row)) for row in body], columns=names, dtype=object)
+        df['系列'] = sheet_name # 把 Sheet 名稱變成系列名稱 (例如: 整套_SDC)
+        
+        # 簡單清洗：移除全空行
+        df.dropna(how='all', inplace=True)
+        sheets.append((sheet_name, df))
+    return sheets
+
+# === 上傳 (差異模式 / 完整覆寫) ===
+def to_grid(df):
+    return [[str(v) for v in row] for row in [df.columns.values.tolist()] + df.values.tolist()]
+
+def update_cells_request(sheet_id, row_index, rows):
+    return {'updateCells': {
+        'start': {'sheetId': sheet_id, 'rowIndex': row_index, 'columnIndex': 0},
+        'rows': [{'values': [{'userEnteredValue': {'stringValue': v}} for v in row]} for row in rows],
+        'fields': 'userEnteredValue'}}
+
+def dimension_range(sheet_id, start, end):
+    return {'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': start, 'endIndex': end}
+
+def diff_requests(sheet_id, old, new, key_columns=None, grid_rows=None):
+    """比對新舊表格 (含標題列)，產生只改動差異列的 batch_update requests 與統計
+
+    以鍵欄位對齊新舊資料列，由下往上產生插入/刪除/覆寫，前面的列號因此不受影響。
+    """
+    header = new[0]
+    key_idx = [header.index(c) for c in key_columns] if key_columns and all(c in header for c in key_columns) else None
+    key = (lambda row: tuple(row[i] for i in key_idx)) if key_idx else tuple
+    old_rows, new_rows = old[1:], new[1:]
+    matcher = SequenceMatcher(None, [key(r) for r in old_rows], [key(r) for r in new_rows], autojunk=False)
+    requests, stats = [], {'updated': 0, 'inserted': 0, 'deleted': 0}
+    tail_growth = 0
+
+    def insert_rows(at, count):
+        nonlocal tail_growth
+        # 插在資料尾端時直接寫到下方的空白列 (不足的格線最後一次補上)
+        if at == len(old_rows): tail_growth += count
+        else: requests.append({'insertDimension': {'range': dimension_range(sheet_id, at + 1, at + 1 + count), 'inheritFromBefore': True}})
+
+    def write_rows(at, rows):
+        requests.append(update_cells_request(sheet_id, at + 1, rows))
+
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            # 鍵相同但內容不同的列，連續的合併成一段寫入
+            k = i2 - i1 - 1
+            while k >= 0:
+                if old_rows[i1 + k] == new_rows[j1 + k]:
+                    k -= 1
+                    continue
+                end = k
+                while k >= 0 and old_rows[i1 + k] != new_rows[j1 + k]: k -= 1
+                write_rows(i1 + k + 1, new_rows[j1 + k + 1:j1 + end + 1])
+                stats['updated'] += end - k
+        elif tag == 'delete':
+            requests.append({'deleteDimension': {'range': dimension_range(sheet_id, i1 + 1, i2 + 1)}})
+            stats['deleted'] += i2 - i1
+        elif tag == 'insert':
+            insert_rows(i1, j2 - j1)
+            write_rows(i1, new_rows[j1:j2])
+            stats['inserted'] += j2 - j1
+        else:  # replace
+            n_old, n_new = i2 - i1, j2 - j1
+            if n_new > n_old: insert_rows(i2, n_new - n_old)
+            elif n_old > n_new: requests.append({'deleteDimension': {'range': dimension_range(sheet_id, i1 + 1 + n_new, i2 + 1)}})
+            write_rows(i1, new_rows[j1:j2])
+            stats['updated'] += min(n_old, n_new)
+            stats['inserted'] += max(n_new - n_old, 0)
+            stats['deleted'] += max(n_old - n_new, 0)
+
+    spare = (grid_rows if grid_rows is not None else len(old)) - len(old)
+    if tail_growth > spare:
+        requests.insert(0, {'appendDimension': {'sheetId': sheet_id, 'dimension': 'ROWS', 'length': tail_growth - spare}})
+    return requests, stats
+
+def request_parts(req, max_cells):
+    """過大的 updateCells 拆成多段，產生 (request, 儲存格數)"""
+    if 'updateCells' not in req:
+        yield req, 1
+        return
+    body = req['updateCells']
+    rows = body['rows']
+    width = max(len(rows[0]['values']), 1) if rows else 1
+    step = max(max_cells // width, 1)
+    for i in range(0, len(rows), step):
+        part = dict(body, start=dict(body['start'], rowIndex=body['start']['rowIndex'] + i), rows=rows[i:i + step])
+        yield {'updateCells': part}, len(part['rows']) * width
+
+def chunk_requests(requests, max_cells=UPLOAD_BATCH_CELLS):
+    """依儲存格數把 requests 切成多批，保持原本順序"""
+    chunk, cells = [], 0
+    for req in requests:
+        for part, size in request_parts(req, max_cells):
+            if chunk and cells + size > max_cells:
+                yield chunk
+                chunk, cells = [], 0
+            chunk.append(part)
+            cells += size
+    if chunk: yield chunk
+
+def rewrite_table(ws, grid, max_cells=UPLOAD_BATCH_CELLS):
+    """完整覆寫：先擴充格線、分段寫入，最後才裁掉多餘的列與欄，過程中分頁不會是空的"""
+    n_rows, n_cols = len(grid), len(grid[0])
+    if ws.row_count < n_rows or ws.col_count < n_cols:
+        sheets_call('resize', ws.resize, rows=max(ws.row_count, n_rows), cols=max(ws.col_count, n_cols))
+    step = max(max_cells // n_cols, 1)
+    for start in range(0, n_rows, step):
+        sheets_call('update', ws.update, values=grid[start:start + step], range_name=f"A{start + 1}")
+    if ws.row_count > n_rows or ws.col_count > n_cols: sheets_call('resize', ws.resize, rows=n_rows, cols=n_cols)
+
+def upload_table(sh, ws, df, key_columns=None, mode='diff'):
+    """上傳表格：diff 模式只送出有變動的列，標題不同或 full 模式時完整覆寫"""
+    grid = to_grid(df)
+    if mode == 'diff':
+        old = sheets_call('get_all_values', ws.get_all_values)
+        if old and old[0] == grid[0] and all(len(row) <= len(grid[0]) for row in old):
+            old = [row + [''] * (len(grid[0]) - len(row)) for row in old]
+            requests, stats = diff_requests(ws.id, old, grid, key_columns, ws.row_count)
+            for chunk in chunk_requests(requests):
+                sheets_call('batch_update', sh.batch_update, {'requests': chunk})
+            print(f"   差異上傳：更新 {stats['updated']} 列、新增 {stats['inserted']} 列、刪除 {stats['deleted']} 列")
+            return
+    rewrite_table(ws, grid)
+    print(f"   完整覆寫：{len(grid) - 1} 列")
+
+def list_general_files():
+    if not os.path.exists(EXCEL_FOLDER): return []
+    return sorted(f for f in os.listdir(EXCEL_FOLDER) if f.endswith(('.xlsx', '.xls')) and f != COMBINATION_FILE)
+
+def process_general_files(client, manifest, use_cache=True, workers=1, upload_mode='diff'):
+    """處理一般經銷牌價 Excel，上傳成功時回傳合併後的 DataFrame"""
     if not os.path.exists(EXCEL_FOLDER): return None
-    files = [f for f in os.listdir(EXCEL_FOLDER) if f.endswith(('.xlsx', '.xls')) and f != COMBINATION_FILE]
+    files = list_general_files()
+    file_paths = [os.path.join(EXCEL_FOLDER, file) for file in files]
     all_data = []
     
     print(f"--- 正在處理一般牌價表 ({len(files)} 個檔案) ---")
-    for file in files:
-        file_path = os.path.join(EXCEL_FOLDER, file)
-        try:
-            xls = pd.ExcelFile(file_path)
-            for sheet_name in xls.sheet_names:
-                header_idx = find_header_row(file_path, sheet_name)
-                df = pd.read_excel(file_path, sheet_name=sheet_name, header=header_idx, dtype=str)
-                df.columns = [clean_header_name(c) for c in df.columns]
-                
-                clean_df = pd.DataFrame(columns=TARGET_COLUMNS)
-                for col in TARGET_COLUMNS:
-                    if col in df.columns: clean_df[col] = df[col]
-                    else: clean_df[col] = ""
-                
-                if '規格' in clean_df.columns:
-                    clean_df = clean_df[clean_df['規格'].str.strip() != '']
-                    
-                if not clean_df.empty:
-                    clean_df['來源檔案'] = file
-                    clean_df['來源分頁'] = sheet_name
-                    all_data.append(clean_df)
-                    print(f" - 讀取: {file} / {sheet_name}")
-        except Exception as e:
-            print(f" X 失敗: {file} - {e}")
+    for file_path, sheets, cached, error in load_workbooks(file_paths, 'general', parse_general_workbook, manifest, use_cache, workers):
+        file = os.path.basename(file_path)
+        if error:
+            print(f" X 失敗: {file} - {error}")
+            continue
+        for sheet_name, clean_df in sheets:
+            all_data.append(clean_df)
+            print(f" - {'快取' if cached else '讀取'}: {file} / {sheet_name}")
             
     if all_data:
         final_df = pd.concat(all_data, ignore_index=True).fillna("")
         try:
-            sh = client.open(GOOGLE_SHEET_NAME)
+            sh = sheets_call('open', client.open, GOOGLE_SHEET_NAME)
             # 上傳到第一頁 (一般資料庫)
-            ws = sh.sheet1 
-            ws.clear()
-            ws.update([final_df.columns.values.tolist()] + final_df.values.tolist())
+            ws = sheets_call('sheet1', getattr, sh, 'sheet1')
+            upload_table(sh, ws, final_df, UPLOAD_KEY_COLUMNS, upload_mode)
             print("✅ 一般牌價資料更新完成！")
-        except Exception as e: print(f"❌ 上傳失敗: {e}")
+            return final_df
+        except Exception as e: print(f"❌ 上傳失敗: {e} (可直接重新執行，會以試算表目前內容重新比對差異)")
+    return None
 
-def process_combination_file(client):
-    """處理組合搭配 Excel"""
+def process_combination_file(client, manifest, use_cache=True, upload_mode='diff'):
+    """處理組合搭配 Excel，上傳成功時回傳合併後的 DataFrame"""
     comb_path = os.path.join(EXCEL_FOLDER, COMBINATION_FILE)
     if not os.path.exists(comb_path):
         print(f"⚠️ 找不到 {COMBINATION_FILE}，跳過組合更新。")
-        return
+        return None
 
     print(f"--- 正在處理組合搭配檔案 ({COMBINATION_FILE}) ---")
     try:
-        xls = pd.ExcelFile(comb_path)
+        _, sheets, cached, error = next(load_workbooks([comb_path], 'combination', parse_combination_workbook, manifest, use_cache))
+        if error: raise error
         all_comb_data = []
-        
-        # 假設組合檔的標題都在第 0 列 (通常是第一列)
-        # 我們把所有 Sheet 合併，但多加一個「系列」欄位
-        for sheet_name in xls.sheet_names:
-            # 跳過非數據頁
-            if sheet_name in ['DATA', '經銷價(總)']: continue
-            
-            # 讀取資料 (假設第一列是標題)
-            df = pd.read_excel(comb_path, sheet_name=sheet_name, dtype=str)
-            df['系列'] = sheet_name # 把 Sheet 名稱變成系列名稱 (例如: 整套_SDC)
-            
-            # 簡單清洗：移除全空行
-            df.dropna(how='all', inplace=True)
+        for sheet_name, df in sheets:
             all_comb_data.append(df)
-            print(f" - 讀取組合: {sheet_name}")
+            print(f" - {'快取' if cached else '讀取'}組合: {sheet_name}")
             
         if all_comb_data:
             final_comb = pd.concat(all_comb_data, ignore_index=True).fillna("")
             
-            sh = client.open(GOOGLE_SHEET_NAME)
+            sh = sheets_call('open', client.open, GOOGLE_SHEET_NAME)
             # 嘗試開啟或建立 'Combinations' 分頁
             try:
-                ws = sh.worksheet('Combinations')
-            except:
-                ws = sh.add_worksheet(title='Combinations', rows="1000", cols="20")
+                ws = sheets_call('worksheet', sh.worksheet, 'Combinations')
+            except gspread.exceptions.WorksheetNotFound:
+                ws = sheets_call('add_worksheet', sh.add_worksheet, title='Combinations', rows="1000", cols="20")
             
-            ws.clear()
-            ws.update([final_comb.columns.values.tolist()] + final_comb.values.tolist())
+            upload_table(sh, ws, final_comb, mode=upload_mode)
             print("✅ 組合搭配資料更新完成！")
+            return final_comb
             
     except Exception as e:
         print(f"❌ 組合檔處理失敗: {e}")
+    return None
+
+def touch_version_stamp(client, stamp):
+    """更新 Users!D1 的資料版本戳記，App 偵測到戳記變動才會重新下載牌價"""
+    try:
+        sh = sheets_call('open', client.open, GOOGLE_SHEET_NAME)
+        ws = sheets_call('worksheet', sh.worksheet, 'Users')
+        sheets_call('update_cell', ws.update_cell, 1, 4, stamp)
+        print("✅ 資料版本戳記已更新")
+    except Exception as e: print(f"⚠️ 版本戳記更新失敗: {e}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="合併 Excel 牌價表並上傳到 Google Sheets")
+    parser.add_argument('--rebuild', action='store_true', help="忽略本機快取，重新解析所有活頁簿")
+    parser.add_argument('--upload', choices=['diff', 'full'], default='diff', help="diff: 只上傳變動的列；full: 完整覆寫")
+    parser.add_argument('--no-snapshot', action='store_true', help="不寫出 App 使用的本機欄式快照")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="平行解析的 process 數 (預設為 CPU 核心數，1 為循序執行)")
+    return parser.parse_args(argv)
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     if not os.path.exists(JSON_KEY_FILE): return
     creds = ServiceAccountCredentials.from_json_keyfile_name(JSON_KEY_FILE, scope)
     client = gspread.authorize(creds)
+    manifest = load_manifest()
+    use_cache = not args.rebuild
     
     # 1. 處理一般檔案
-    process_general_files(client)
+    general_df = process_general_files(client, manifest, use_cache, args.workers, args.upload)
     # 2. 處理組合檔案
-    process_combination_file(client)
+    comb_df = process_combination_file(client, manifest, use_cache, args.upload)
+    if general_df is not None or comb_df is not None:
+        stamp = get_tw_time()
+        # 3. 寫出本機欄式快照 (與 Sheets 內容相同、戳記相同，App 啟動時優先讀取)
+        if general_df is not None and not args.no_snapshot:
+            try:
+                write_snapshot(general_df, comb_df, stamp)
+                print("✅ 本機快照已寫出")
+            except Exception as e: print(f"⚠️ 本機快照寫出失敗: {e}")
+        # 4. 資料都上傳完才更新戳記，App 才不會讀到一半的資料
+        touch_version_stamp(client, stamp)
+    # 5. 保存 manifest，下次只重新解析有變動的活頁簿
+    prune_cache(manifest, set(list_general_files()) | {COMBINATION_FILE})
+    save_manifest(manifest)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
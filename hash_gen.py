@@ -1,10 +1,13 @@
+import sys
 import bcrypt
 
 # 在這裡輸入您想設定的初始管理員密碼
 my_password = "admin"  # <--- 您可以改成您要的密碼
+# bcrypt 成本，請與 secrets 的 bcrypt_rounds 一致 (也可執行 python hash_gen.py 13 指定)
+rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 12
 
 # 產生加密字串
-hashed = bcrypt.hashpw(my_password.encode('utf-8'), bcrypt.gensalt())
+hashed = bcrypt.hashpw(my_password.encode('utf-8'), bcrypt.gensalt(rounds))
 print("請將下方這串亂碼，複製貼上到 Google Sheet 的 password 欄位：")
 print("-" * 30)
 print(hashed.decode('utf-8'))
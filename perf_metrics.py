@@ -0,0 +1,100 @@
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+# === 設定區 ===
+METRICS_WINDOW = 500          # 每個階段保留最近幾次的耗時，用來算滾動 p50/p95
+METRICS_PREFIX = 'price_system'
+
+# === 耗時與快取統計 ===
+class Metrics:
+    """整個 process 共用的效能統計：各階段的滾動耗時與快取命中率，所有 session 寫入同一份"""
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._timings = {}   # 階段 -> deque[秒]
+        self._counts = {}    # 階段 -> [總次數, 錯誤次數]
+        self._caches = {}    # 快取 -> [查詢次數, 未命中次數]
+        self.started_at = time.time()
+
+    def observe(self, name, seconds, error=False):
+        with self._lock:
+            samples = self._timings.get(name)
+            if samples is None: samples = self._timings[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+            counts = self._counts.setdefault(name, [0, 0])
+            counts[0] += 1
+            if error: counts[1] += 1
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        error = False
+        try: yield
+        except BaseException:
+            error = True
+            raise
+        finally: self.observe(name, time.perf_counter() - start, error)
+
+    def call(self, name, fn, *args, **kwargs):
+        with self.timed(name): return fn(*args, **kwargs)
+
+    def lookup(self, cache, miss=False):
+        with self._lock:
+            counts = self._caches.setdefault(cache, [0, 0])
+            counts[0] += 1
+            if miss: counts[1] += 1
+
+    def miss(self, cache):
+        """只記未命中 (在被快取的函式內呼叫)，查詢次數另由 lookup 記錄"""
+        with self._lock: self._caches.setdefault(cache, [0, 0])[1] += 1
+
+    def timings(self):
+        """[{階段, 次數, 錯誤, p50_ms, p95_ms, max_ms}]，p50/p95 只看最近 window 次"""
+        with self._lock:
+            items = [(name, np.asarray(samples), list(self._counts[name])) for name, samples in self._timings.items()]
+        rows = []
+        for name, samples, (total, errors) in sorted(items):
+            p50, p95 = np.percentile(samples, [50, 95]) * 1000
+            rows.append({'階段': name, '次數': total, '錯誤': errors,
+                         'p50_ms': round(float(p50), 1), 'p95_ms': round(float(p95), 1), 'max_ms': round(float(samples.max()) * 1000, 1)})
+        return rows
+
+    def cache_ratios(self):
+        with self._lock: items = {name: list(counts) for name, counts in self._caches.items()}
+        rows = []
+        for name, (lookups, misses) in sorted(items.items()):
+            # 快取函式在沒有 lookup 的路徑被呼叫時，未命中數可能多於查詢數
+            lookups = max(lookups, misses)
+            rows.append({'快取': name, '查詢': lookups, '未命中': misses,
+                         '命中率': round((lookups - misses) / lookups, 3) if lookups else None})
+        return rows
+
+    def to_json(self):
+        return json.dumps({'started_at': self.started_at, 'generated_at': time.time(),
+                           'timings': self.timings(), 'caches': self.cache_ratios()}, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self):
+        """Prometheus text exposition 格式，可存成 node_exporter textfile"""
+        lines = [f'# TYPE {METRICS_PREFIX}_stage_seconds summary']
+        for row in self.timings():
+            label = f'stage="{escape_label(row["階段"])}"'
+            lines.append(f'{METRICS_PREFIX}_stage_seconds{{{label},quantile="0.5"}} {row["p50_ms"] / 1000:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds{{{label},quantile="0.95"}} {row["p95_ms"] / 1000:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_count{{{label}}} {row["次數"]}')
+            lines.append(f'{METRICS_PREFIX}_stage_errors_total{{{label}}} {row["錯誤"]}')
+        lines.append(f'# TYPE {METRICS_PREFIX}_cache_lookups_total counter')
+        for row in self.cache_ratios():
+            label = f'cache="{escape_label(row["快取"])}"'
+            lines.append(f'{METRICS_PREFIX}_cache_lookups_total{{{label}}} {row["查詢"]}')
+            lines.append(f'{METRICS_PREFIX}_cache_misses_total{{{label}}} {row["未命中"]}')
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# 模組只載入一次，Streamlit 每次 rerun 都共用同一個實例
+METRICS = Metrics()
@@ -0,0 +1,244 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+from sheets_gateway import SheetsGateway
+from catalog_engine import CatalogStore, SheetsSource, search_positions, row_key, parse_bom_text, parse_bom_number, normalize_bom_frame
+
+# === 設定區 ===
+GOOGLE_SHEET_NAME = '經銷牌價表_資料庫'
+JSON_KEY_FILE = os.environ.get('PRICE_SERVICE_KEY_FILE', 'service_account.json')
+DEFAULT_HOST = '127.0.0.1'          # 預設只接受本機連線
+DEFAULT_PORT = 8765
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 500
+MAX_BODY_BYTES = 2 * 1024 * 1024
+ITEM_COLUMNS = ['規格', 'NO.', '說明', '牌價_數值', '經銷價_數值', '需洽詢', '訂購品(V)', '來源檔案', '來源分頁']
+
+# === 牌價資料 ===
+def get_client():
+    """與 App 相同的 service account；沒有金鑰檔時只使用本機快照"""
+    if not os.path.exists(JSON_KEY_FILE): return None
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    creds = ServiceAccountCredentials.from_json_keyfile_name(JSON_KEY_FILE, scope)
+    return gspread.authorize(creds)
+
+def create_store(sheet_name=GOOGLE_SHEET_NAME):
+    gateway = SheetsGateway()
+    return CatalogStore(SheetsSource.from_client(get_client, sheet_name, gateway.call))
+
+def json_value(value):
+    if isinstance(value, (np.floating, float)): return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer): return int(value)
+    if isinstance(value, np.bool_): return bool(value)
+    return value
+
+def item_records(df, rows):
+    """列位置 -> JSON 物件；價格以數值輸出，無價格為 null"""
+    columns = [c for c in ITEM_COLUMNS if c in df.columns]
+    # 逐欄取出結果列，不建立中間 DataFrame
+    values = {col: df[col].take(rows).tolist() for col in columns}
+    items = []
+    for i in range(len(rows)):
+        row = {col: values[col][i] for col in columns}
+        item = {'id': row_key(row)}
+        for col, value in row.items(): item[col.replace('_數值', '')] = json_value(value)
+        items.append(item)
+    return items
+
+def frame_records(df):
+    return [{k: json_value(v) for k, v in row.items()} for row in df.to_dict('records')]
+
+# === 查詢 ===
+def search(catalog, term, limit=DEFAULT_LIMIT, offset=0):
+    limit = min(max(int(limit), 0), MAX_LIMIT)
+    offset = max(int(offset), 0)
+    # 只排序到 offset + limit，總數由搜尋直接計數
+    rows, total = search_positions(catalog, term, max(offset + limit, 1))
+    return {'query': term, 'total': int(total), 'offset': offset, 'items': item_records(catalog.df, rows[offset:offset + limit])}
+
+def valid_specs(specs):
+    return isinstance(specs, list) and all(isinstance(s, (str, int, float)) and not isinstance(s, bool) for s in specs)
+
+def lookup(catalog, specs):
+    """以規格 / NO. 精確比對 (與批量報價相同的索引)，每個輸入回傳一筆結果"""
+    bom = pd.DataFrame({'規格': [str(s) for s in specs], '數量': 1, '折數': ''})
+    result = catalog.parts.quote(bom)
+    return {'items': frame_records(result[['輸入', '狀態', '規格', '說明', '牌價', '經銷價']])}
+
+def valid_number(value):
+    """數字或數字字串 (可含千分位、%)；未提供或空白時使用預設值"""
+    if value is None or value == '': return True
+    if isinstance(value, bool): return False
+    if isinstance(value, (int, float)): return True
+    return isinstance(value, str) and not np.isnan(parse_bom_number(value, 0.0))
+
+def quote_lines(payload):
+    """{"text": "..."} 或 {"lines": [{"spec": ..., "qty": ..., "discount": ...}]} -> BOM DataFrame"""
+    if 'text' in payload: return parse_bom_text(str(payload['text']))
+    lines = payload.get('lines') or []
+    if not isinstance(lines, list) or not all(isinstance(line, dict) for line in lines): raise ValueError('lines 必須是物件陣列')
+    if not all(valid_number(line.get('qty')) and valid_number(line.get('discount')) for line in lines):
+        raise ValueError('qty / discount 必須是數字')
+    return normalize_bom_frame(pd.DataFrame({
+        '規格': [str(line.get('spec', '')) for line in lines],
+        '數量': [line.get('qty', 1) for line in lines],
+        '折數': [line.get('discount', '') for line in lines],
+    }))
+
+def quote(catalog, bom, discount=100.0):
+    result = catalog.parts.quote(bom, float(discount))
+    return {
+        'total': json_value(result['小計'].sum()),
+        'status': {k: int(v) for k, v in result['狀態'].value_counts().items()},
+        'lines': frame_records(result),
+    }
+
+# === HTTP 服務 ===
+class PriceRequestHandler(BaseHTTPRequestHandler):
+    """每個請求只讀取一次 store.snapshot，整個請求都用同一版資料；不經過 Streamlit rerun"""
+    store = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # 標頭與內容分兩次寫出，避免 Nagle + delayed ACK 造成 40ms 延遲
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        catalog = self.store.snapshot
+        if url.path == '/health':
+            return self.reply(200, {'status': 'ok' if self.store.ok else 'degraded', 'rows': len(catalog.df),
+                                    'update_date': catalog.update_date, 'loaded_at': catalog.loaded_at,
+                                    'age_seconds': round(time.time() - catalog.loaded_at, 1)})
+        if url.path == '/search':
+            term = params.get('q', [''])[0]
+            try: limit, offset = int(params.get('limit', [DEFAULT_LIMIT])[0]), int(params.get('offset', [0])[0])
+            except ValueError: return self.reply(400, {'error': 'limit / offset 必須是整數'})
+            # 含正規表示式符號的查詢走 str.contains，語法錯誤時 (re / pyarrow 都是 ValueError 系) 回報是哪個查詢
+            try: return self.reply(200, search(catalog, term, limit, offset))
+            except (re.error, ValueError): return self.reply(400, {'error': f'查詢字串不是有效的正規表示式：{term}'})
+        if url.path == '/lookup':
+            specs = params.get('spec', [])
+            if not specs: return self.reply(400, {'error': '請提供 spec 參數'})
+            return self.reply(200, lookup(catalog, specs))
+        self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        payload = self.read_json()
+        if payload is None: return
+        catalog = self.store.snapshot
+        if url.path == '/lookup':
+            specs = payload.get('specs')
+            if not valid_specs(specs): return self.reply(400, {'error': 'specs 必須是字串或數字的陣列'})
+            return self.reply(200, lookup(catalog, specs))
+        if url.path == '/quote':
+            discount = payload.get('discount', 100.0)
+            if discount is None or discount == '' or not valid_number(discount):
+                return self.reply(400, {'error': 'discount 必須是數字'})
+            try: return self.reply(200, quote(catalog, quote_lines(payload), parse_bom_number(discount, 100.0)))
+            except (TypeError, ValueError) as e: return self.reply(400, {'error': str(e) or 'lines 格式錯誤'})
+        self.reply(404, {'error': 'not found'})
+
+    def read_json(self):
+        try: length = int(self.headers.get('Content-Length') or 0)
+        except ValueError: length = -1
+        # 負數會讓 rfile.read 一直讀到對方關閉連線，佔住處理執行緒
+        if length < 0:
+            self.reply(400, {'error': 'invalid Content-Length'})
+            return None
+        if length > MAX_BODY_BYTES:
+            self.reply(413, {'error': 'request too large'})
+            return None
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(payload, dict): raise ValueError
+            return payload
+        except ValueError:
+            self.reply(400, {'error': 'invalid JSON'})
+            return None
+
+    def reply(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(store, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    handler = type('Handler', (PriceRequestHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"✅ 牌價服務啟動：http://{host}:{port} (共 {len(store.snapshot.df)} 筆，資料版本 {store.snapshot.update_date or '本機快照'})")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: server.server_close()
+
+# === CLI ===
+def read_bom_file(path):
+    if path == '-': return parse_bom_text(sys.stdin.read())
+    lower = path.lower()
+    if lower.endswith('.csv'): return normalize_bom_frame(pd.read_csv(path, dtype=str))
+    if lower.endswith(('.xlsx', '.xls')): return normalize_bom_frame(pd.read_excel(path, dtype=str))
+    with open(path, encoding='utf-8') as f: return parse_bom_text(f.read())
+
+def write_quote(result, out):
+    df = pd.DataFrame(result['lines'])
+    if out.lower().endswith('.xlsx'): df.to_excel(out, index=False, sheet_name='報價明細')
+    elif out.lower().endswith('.csv'): df.to_csv(out, index=False, encoding='utf-8-sig')
+    else:
+        with open(out, 'w', encoding='utf-8') as f: json.dump(result, f, ensure_ascii=False, indent=2)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="牌價查詢服務 / 命令列批次查詢 (與 App 共用同一套資料與索引)")
+    parser.add_argument('--sheet', default=GOOGLE_SHEET_NAME, help="Google 試算表名稱")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('serve', help="啟動本機 HTTP/JSON 服務")
+    p.add_argument('--host', default=DEFAULT_HOST)
+    p.add_argument('--port', type=int, default=DEFAULT_PORT)
+    p = sub.add_parser('search', help="關鍵字搜尋 (容錯、依相關度排序)")
+    p.add_argument('term')
+    p.add_argument('--limit', type=int, default=DEFAULT_LIMIT)
+    p = sub.add_parser('lookup', help="以規格 / NO. 精確查價")
+    p.add_argument('specs', nargs='+')
+    p = sub.add_parser('quote', help="批量報價：BOM 檔 (xlsx/csv/文字檔，- 為標準輸入)")
+    p.add_argument('file')
+    p.add_argument('--discount', type=float, default=100.0, help="整批販售折數 (%%)")
+    p.add_argument('--out', help="輸出檔 (.xlsx/.csv/.json)，未指定時輸出 JSON 到標準輸出")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = create_store(args.sheet)
+    if store.snapshot.df.empty:
+        print("❌ 無法載入牌價資料 (請確認 service_account.json 或本機快照)", file=sys.stderr)
+        return 1
+    if args.command == 'serve':
+        serve(store, args.host, args.port)
+        return 0
+    catalog = store.snapshot
+    if args.command == 'search': result = search(catalog, args.term, args.limit)
+    elif args.command == 'lookup': result = lookup(catalog, args.specs)
+    else:
+        result = quote(catalog, read_bom_file(args.file), args.discount)
+        if args.out:
+            write_quote(result, args.out)
+            print(f"✅ 報價已寫入 {args.out} (合計 {result['total'] or 0:,.0f})")
+            return 0
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import time
+import random
+import threading
+import requests
+import urllib3
+import gspread
+from perf_metrics import METRICS
+
+# === 設定區 ===
+# Google Sheets API 預設配額：每個使用者 (service account) 每分鐘讀、寫各 60 次
+READ_PER_MINUTE = 60
+WRITE_PER_MINUTE = 60
+BURST = 10                    # 閒置後允許連續送出的次數
+MAX_RETRIES = 5
+BASE_DELAY = 1.0              # 第一次重試的退避上限 (秒)，之後每次加倍
+MAX_DELAY = 32.0
+MAX_WAIT = 60.0               # 排隊等配額超過這個秒數就放棄
+RETRY_STATUS = {429, 500, 502, 503, 504}
+WRITE_RETRY_STATUS = {429}    # 寫入只在確定沒有被執行時重試：5xx / 斷線時伺服器可能已經寫入
+WRITE_CALLS = {'update', 'update_cell', 'update_cells', 'append_row', 'append_rows', 'batch_update',
+               'resize', 'add_worksheet', 'clear', 'delete_rows', 'insert_rows'}
+NO_QUOTA_CALLS = {'authorize'}  # 只換 OAuth token，不占 Sheets 配額
+
+class SheetsBusyError(Exception):
+    """排隊等配額超過 MAX_WAIT"""
+
+# === 配額控制 ===
+class TokenBucket:
+    """每分鐘 rate 個 token、最多累積 burst 個；取不到時排隊等補充"""
+    def __init__(self, rate_per_minute, burst=BURST):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """預約一個 token，回傳需要等待的秒數 (先到先排，等待中的呼叫不會互相插隊)"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def cancel(self):
+        with self._lock: self.tokens = min(self.capacity, self.tokens + 1)
+
+    def acquire(self, max_wait=MAX_WAIT):
+        wait = self.reserve()
+        if wait > max_wait:
+            self.cancel()
+            raise SheetsBusyError(f"Sheets 配額已滿，需等待 {wait:.0f} 秒")
+        if wait > 0: time.sleep(wait)
+        return wait
+
+def is_retryable(error):
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, 'status_code', None) in RETRY_STATUS
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def is_unsent(error):
+    """在建立連線階段就失敗 (DNS、連線被拒、連線逾時)，請求確定沒有送出"""
+    if isinstance(error, requests.exceptions.ConnectTimeout): return True
+    if not isinstance(error, requests.exceptions.ConnectionError): return False
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, 'reason', reason), urllib3.exceptions.NewConnectionError)
+
+def is_retryable_write(error):
+    """以列號插入/刪除的 batch_update、append_rows 重送會刪錯列或寫入重複資料，只重試確定沒被執行的失敗"""
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, 'status_code', None) in WRITE_RETRY_STATUS
+    return is_unsent(error)
+
+def retry_after(error):
+    """429 回應若帶 Retry-After 標頭，以它為準"""
+    try: return float(error.response.headers.get('Retry-After'))
+    except Exception: return None
+
+class _Pending:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SheetsGateway:
+    """所有 gspread 呼叫的單一出口：讀/寫分開的 token bucket、相同讀取合併為一次、以抖動指數退避重試
+    (讀取遇 429/5xx/斷線重試；寫入只在 429 或請求未送出時重試，其他失敗直接拋出讓呼叫端重新比對)"""
+    def __init__(self, read_per_minute=READ_PER_MINUTE, write_per_minute=WRITE_PER_MINUTE, burst=BURST,
+                 max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY, max_wait=MAX_WAIT):
+        self.buckets = {'read': TokenBucket(read_per_minute, burst), 'write': TokenBucket(write_per_minute, burst)}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def call(self, name, fn, *args, **kwargs):
+        if name in NO_QUOTA_CALLS: return METRICS.call(f"sheets.{name}", fn, *args, **kwargs)
+        if name in WRITE_CALLS: return self._execute('write', name, fn, args, kwargs)
+        return self._coalesced(name, fn, args, kwargs)
+
+    def _coalesced(self, name, fn, args, kwargs):
+        """同一物件、同樣參數的讀取正在進行時，直接等那一次的結果，不另外送出請求"""
+        key = (name, id(getattr(fn, '__self__', fn)), args, tuple(sorted(kwargs.items())))
+        try: hash(key)
+        except TypeError: return self._execute('read', name, fn, args, kwargs)
+        with self._lock:
+            pending = self._inflight.get(key)
+            leader = pending is None
+            if leader: pending = self._inflight[key] = _Pending()
+        METRICS.lookup("Sheets 讀取合併", miss=leader)
+        if not leader:
+            pending.done.wait()
+            if pending.error is not None: raise pending.error
+            return pending.result
+        try:
+            pending.result = self._execute('read', name, fn, args, kwargs)
+            return pending.result
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock: self._inflight.pop(key, None)
+            pending.done.set()
+
+    def _execute(self, kind, name, fn, args, kwargs):
+        with METRICS.timed(f"sheets.{name}"):
+            for attempt in range(self.max_retries + 1):
+                waited = self.buckets[kind].acquire(self.max_wait)
+                if waited: METRICS.observe(f"sheets.{kind}_throttled", waited)
+                try: return fn(*args, **kwargs)
+                except Exception as e:
+                    retryable = is_retryable_write(e) if kind == 'write' else is_retryable(e)
+                    if attempt == self.max_retries or not retryable: raise
+                    # full jitter：在 0 ~ 退避上限之間隨機等待，避免各 session 同時重試
+                    delay = retry_after(e) or random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    METRICS.observe(f"sheets.{kind}_retry", delay)
+                    time.sleep(delay)